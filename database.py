@@ -1,5 +1,5 @@
 import sqlite3
-import json
+import orjson
 import threading
 from datetime import datetime
 from typing import List, Dict, Optional, Any
@@ -16,6 +16,11 @@ _conn_init_lock = threading.Lock()
 _thread_local = threading.local()
 
 
+def _dumps(value: Any) -> str:
+    """Serialize to JSON text with orjson; columns stay TEXT so existing rows remain readable."""
+    return orjson.dumps(value).decode()
+
+
 class Database:
     def __init__(self, db_path: str = "bot_data.db"):
         self.db_path = db_path
@@ -125,6 +130,35 @@ class Database:
             """
             )
 
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS target_peers (
+                    user_id INTEGER,
+                    target_id INTEGER,
+                    peer_type TEXT,
+                    peer_id INTEGER,
+                    access_hash INTEGER,
+                    updated_at TEXT DEFAULT (datetime('now')),
+                    PRIMARY KEY (user_id, target_id)
+                )
+            """
+            )
+
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pending_sends (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    target_id INTEGER,
+                    message_text TEXT,
+                    forward_tag INTEGER DEFAULT 0,
+                    source_peer TEXT,
+                    message_id INTEGER,
+                    created_at TEXT DEFAULT (datetime('now'))
+                )
+            """
+            )
+
             conn.commit()
             # REMOVED: self.close_connection() - Keep connection open for subsequent operations
 
@@ -202,6 +236,24 @@ class Database:
             raise
         # REMOVED: finally: self.close_connection() - Keep connection open
 
+    def mark_users_logged_out(self, user_ids: List[int]):
+        """Flag several users logged out in one transaction"""
+        if not user_ids:
+            return
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            now = datetime.now().isoformat()
+            cur.executemany(
+                "UPDATE users SET is_logged_in = 0, updated_at = ? WHERE user_id = ?",
+                [(now, user_id) for user_id in user_ids],
+            )
+            conn.commit()
+        except Exception as e:
+            logger.exception("Error in mark_users_logged_out for %d user(s): %s", len(user_ids), e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
     def add_forwarding_task(self, user_id: int, label: str, source_ids: List[int], target_ids: List[int], filters: Optional[Dict[str, Any]] = None) -> bool:
         conn = self.get_connection()
         try:
@@ -229,7 +281,7 @@ class Database:
                     INSERT INTO forwarding_tasks (user_id, label, source_ids, target_ids, filters)
                     VALUES (?, ?, ?, ?, ?)
                 """,
-                    (user_id, label, json.dumps(source_ids), json.dumps(target_ids), json.dumps(filters)),
+                    (user_id, label, _dumps(source_ids), _dumps(target_ids), _dumps(filters)),
                 )
                 conn.commit()
                 return True
@@ -248,10 +300,10 @@ class Database:
             cur.execute(
                 """
                 UPDATE forwarding_tasks 
-                SET filters = ?, updated_at = ?
+                SET filters = ?
                 WHERE user_id = ? AND label = ?
                 """,
-                (json.dumps(filters), datetime.now().isoformat(), user_id, label),
+                (_dumps(filters), user_id, label),
             )
             updated = cur.rowcount > 0
             conn.commit()
@@ -291,16 +343,16 @@ class Database:
             tasks = []
             for row in cur.fetchall():
                 try:
-                    filters_data = json.loads(row["filters"]) if row["filters"] else {}
-                except (json.JSONDecodeError, TypeError):
+                    filters_data = orjson.loads(row["filters"]) if row["filters"] else {}
+                except (orjson.JSONDecodeError, TypeError):
                     filters_data = {}
                     
                 tasks.append(
                     {
                         "id": row["id"],
                         "label": row["label"],
-                        "source_ids": json.loads(row["source_ids"]) if row["source_ids"] else [],
-                        "target_ids": json.loads(row["target_ids"]) if row["target_ids"] else [],
+                        "source_ids": orjson.loads(row["source_ids"]) if row["source_ids"] else [],
+                        "target_ids": orjson.loads(row["target_ids"]) if row["target_ids"] else [],
                         "filters": filters_data,
                         "is_active": row["is_active"],
                         "created_at": row["created_at"],
@@ -327,8 +379,8 @@ class Database:
             tasks = []
             for row in cur.fetchall():
                 try:
-                    filters_data = json.loads(row["filters"]) if row["filters"] else {}
-                except (json.JSONDecodeError, TypeError):
+                    filters_data = orjson.loads(row["filters"]) if row["filters"] else {}
+                except (orjson.JSONDecodeError, TypeError):
                     filters_data = {}
                     
                 tasks.append(
@@ -336,8 +388,8 @@ class Database:
                         "user_id": row["user_id"],
                         "id": row["id"],
                         "label": row["label"],
-                        "source_ids": json.loads(row["source_ids"]) if row["source_ids"] else [],
-                        "target_ids": json.loads(row["target_ids"]) if row["target_ids"] else [],
+                        "source_ids": orjson.loads(row["source_ids"]) if row["source_ids"] else [],
+                        "target_ids": orjson.loads(row["target_ids"]) if row["target_ids"] else [],
                         "filters": filters_data,
                     }
                 )
@@ -347,6 +399,152 @@ class Database:
             raise
         # REMOVED: finally: self.close_connection() - Keep connection open
 
+    def save_target_peer(self, user_id: int, target_id: int, peer_type: str, peer_id: int, access_hash: int):
+        """Remember a resolved target peer so restarts can skip re-resolving it"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                INSERT OR REPLACE INTO target_peers (user_id, target_id, peer_type, peer_id, access_hash, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                (user_id, target_id, peer_type, peer_id, access_hash, datetime.now().isoformat()),
+            )
+            conn.commit()
+        except Exception as e:
+            logger.exception("Error in save_target_peer for %s, target %s: %s", user_id, target_id, e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
+    def get_target_peers(self, user_id: int) -> Dict[int, Dict]:
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT target_id, peer_type, peer_id, access_hash
+                FROM target_peers
+                WHERE user_id = ?
+            """,
+                (user_id,),
+            )
+            peers = {}
+            for row in cur.fetchall():
+                peers[row["target_id"]] = {
+                    "peer_type": row["peer_type"],
+                    "peer_id": row["peer_id"],
+                    "access_hash": row["access_hash"],
+                }
+            return peers
+        except Exception as e:
+            logger.exception("Error in get_target_peers for %s: %s", user_id, e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
+    def clear_target_peers(self, user_id: int):
+        """Drop stored peers; access hashes belong to the account that resolved them"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM target_peers WHERE user_id = ?", (user_id,))
+            conn.commit()
+        except Exception as e:
+            logger.exception("Error in clear_target_peers for %s: %s", user_id, e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
+    def save_pending_sends(self, sends: List[Dict]):
+        """Store forwards that were still queued at shutdown so the next start can deliver them"""
+        if not sends:
+            return
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.executemany(
+                """
+                INSERT INTO pending_sends (user_id, target_id, message_text, forward_tag, source_peer, message_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                [
+                    (
+                        send["user_id"],
+                        send["target_id"],
+                        send["message_text"],
+                        1 if send.get("forward_tag") else 0,
+                        _dumps(send["source_peer"]) if send.get("source_peer") else None,
+                        send.get("message_id"),
+                    )
+                    for send in sends
+                ],
+            )
+            conn.commit()
+        except Exception as e:
+            logger.exception("Error in save_pending_sends for %d send(s): %s", len(sends), e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
+    def get_pending_sends(self, user_id: Optional[int] = None) -> List[Dict]:
+        """Return stored pending sends in queue order, optionally only one user's"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            query = """
+                SELECT id, user_id, target_id, message_text, forward_tag, source_peer, message_id
+                FROM pending_sends
+            """
+            if user_id is None:
+                cur.execute(query + " ORDER BY id")
+            else:
+                cur.execute(query + " WHERE user_id = ? ORDER BY id", (user_id,))
+            sends = []
+            for row in cur.fetchall():
+                try:
+                    source_peer = orjson.loads(row["source_peer"]) if row["source_peer"] else None
+                except (orjson.JSONDecodeError, TypeError):
+                    source_peer = None
+                sends.append(
+                    {
+                        "id": row["id"],
+                        "user_id": row["user_id"],
+                        "target_id": row["target_id"],
+                        "message_text": row["message_text"],
+                        "forward_tag": bool(row["forward_tag"]),
+                        "source_peer": source_peer,
+                        "message_id": row["message_id"],
+                    }
+                )
+            return sends
+        except Exception as e:
+            logger.exception("Error in get_pending_sends: %s", e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
+    def delete_pending_sends(self, send_ids: List[int]):
+        if not send_ids:
+            return
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.executemany("DELETE FROM pending_sends WHERE id = ?", [(send_id,) for send_id in send_ids])
+            conn.commit()
+        except Exception as e:
+            logger.exception("Error in delete_pending_sends for %d send(s): %s", len(send_ids), e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
+    def clear_pending_sends(self, user_id: int):
+        """Drop a user's stored sends; a deliberate logout stops their forwarding"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM pending_sends WHERE user_id = ?", (user_id,))
+            conn.commit()
+        except Exception as e:
+            logger.exception("Error in clear_pending_sends for %s: %s", user_id, e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
     def is_user_allowed(self, user_id: int) -> bool:
         conn = self.get_connection()
         try:
@@ -391,6 +589,29 @@ class Database:
             raise
         # REMOVED: finally: self.close_connection() - Keep connection open
 
+    def bootstrap_allowed_users(self, owner_ids: List[int], allowed_ids: List[int]):
+        """Upsert env-configured owners (as admins) and allowed users in one transaction"""
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.executemany(
+                """
+                INSERT INTO allowed_users (user_id, is_admin) VALUES (?, 1)
+                ON CONFLICT(user_id) DO UPDATE SET is_admin = 1
+            """,
+                [(user_id,) for user_id in owner_ids],
+            )
+            # Existing rows keep their admin flag
+            cur.executemany(
+                "INSERT INTO allowed_users (user_id, is_admin) VALUES (?, 0) ON CONFLICT(user_id) DO NOTHING",
+                [(user_id,) for user_id in allowed_ids],
+            )
+            conn.commit()
+        except Exception as e:
+            logger.exception("Error in bootstrap_allowed_users: %s", e)
+            raise
+        # REMOVED: finally: self.close_connection() - Keep connection open
+
     def remove_allowed_user(self, user_id: int) -> bool:
         conn = self.get_connection()
         try:
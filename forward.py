@@ -4,12 +4,28 @@ import asyncio
 import logging
 import functools
 import gc
+import html
 import re
-from typing import Dict, List, Optional, Tuple, Set, Callable, Any
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import DefaultDict, Dict, Iterable, List, Optional, Tuple, Set, Callable, Any
+try:
+    import psutil
+except ImportError:  # memory metric is reported as None without it
+    psutil = None
 from telethon import TelegramClient, events
 from telethon.sessions import StringSession
 from telethon.errors import SessionPasswordNeededError, FloodWaitError
+from telethon.extensions import markdown
+from telethon.tl.types import (
+    User, Channel, Chat, InputPeerUser, InputPeerChannel, InputPeerChat,
+    MessageEntityTextUrl, MessageEntityMentionName, InputMessageEntityMentionName,
+)
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -59,11 +75,21 @@ if allowed_env:
 # OPTIMIZED Tuning parameters for Render free tier (25+ users, unlimited forwarding)
 SEND_WORKER_COUNT = int(os.getenv("SEND_WORKER_COUNT", "15"))  # Reduced workers to save memory
 SEND_QUEUE_MAXSIZE = int(os.getenv("SEND_QUEUE_MAXSIZE", "10000"))  # Reduced queue size
+USER_SEND_CONCURRENCY = int(os.getenv("USER_SEND_CONCURRENCY", "3"))  # Concurrent sends per account
 TARGET_RESOLVE_RETRY_SECONDS = int(os.getenv("TARGET_RESOLVE_RETRY_SECONDS", "30"))  # Faster retry
+TARGET_RESOLVE_CONCURRENCY = int(os.getenv("TARGET_RESOLVE_CONCURRENCY", "10"))  # Resolve calls in flight across all users
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", "8"))  # Sessions restored at once
+SHUTDOWN_DISCONNECT_TIMEOUT = 15  # Upper bound on disconnecting every client at shutdown
+SHUTDOWN_DRAIN_TIMEOUT = 10  # Time queued forwards get to finish sending before workers are cancelled
+RESTORE_TIMEOUT_SECONDS = int(os.getenv("RESTORE_TIMEOUT_SECONDS", "30"))  # Give up on a hung session restore
 MAX_CONCURRENT_USERS = int(os.getenv("MAX_CONCURRENT_USERS", "50"))  # Increased user limit
 MESSAGE_PROCESS_BATCH_SIZE = int(os.getenv("MESSAGE_PROCESS_BATCH_SIZE", "5"))  # Batch processing
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))  # Allow-list lookup cache lifetime
+DB_WORKER_COUNT = int(os.getenv("DB_WORKER_COUNT", "4"))  # Dedicated threads for SQLite calls
 
 db = Database()
+# DB work gets its own small pool so it never queues behind other to_thread users
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKER_COUNT, thread_name_prefix="db")
 
 # OPTIMIZED: Use weak references and smaller data structures
 user_clients: Dict[int, TelegramClient] = {}
@@ -73,58 +99,326 @@ logout_states: Dict[int, Dict] = {}
 # Task creation states
 task_creation_states: Dict[int, Dict[str, Any]] = {}  # user_id -> {step: str, name: str, source_ids: List[int], target_ids: List[int]}
 
+# Default task settings; read-only prototypes copied by _make_default_task_filters()
+_DEFAULT_FILTERS = MappingProxyType({
+    "raw_text": False,
+    "numbers_only": False,
+    "alphabets_only": False,
+    "removed_alphabetic": False,
+    "removed_numeric": False,
+    "prefix": "",
+    "suffix": "",
+})
+_DEFAULT_TASK_SETTINGS = MappingProxyType({
+    "outgoing": True,
+    "forward_tag": False,
+    "control": True,
+})
+
 # OPTIMIZED: Hot-path caches with memory limits
-tasks_cache: Dict[int, List[Dict]] = {}  # user_id -> list of task dicts
+tasks_cache: Dict[int, Dict[str, Dict]] = {}  # user_id -> {label: task dict}, insertion ordered
+source_index: Dict[int, Dict[int, Tuple[Dict, ...]]] = {}  # user_id -> {source chat_id: tasks reading it}
+task_counts: Dict[int, int] = {}  # user_id -> number of tasks, kept alongside source_index for /metrics
 target_entity_cache: Dict[int, Dict[int, object]] = {}  # user_id -> {target_id: resolved_entity}
+_inflight_resolves: Dict[Tuple[int, int], asyncio.Future] = {}  # (user_id, target_id) -> lookup in progress
 # handler_registered maps user_id -> handler callable (so we can remove it)
 handler_registered: Dict[int, Callable] = {}
 
-# Global send queue is created later on the running event loop (in post_init/start_send_workers)
-send_queue: Optional[asyncio.Queue] = None
-
-UNAUTHORIZED_MESSAGE = """🚫 **Access Denied!** 
+# OPTIMIZED: Cached DB allow-list results, user_id -> (is_allowed, cached_at monotonic)
+_auth_cache: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+_AUTH_CACHE_MAX_ENTRIES = MAX_CONCURRENT_USERS * 2
+
+# OPTIMIZED: Debounced task filter writes, (user_id, label) -> pending timer
+_pending_filter_writes: Dict[Tuple[int, str], asyncio.TimerHandle] = {}
+# Fire-and-forget DB writes in progress; the loop only holds tasks weakly, and shutdown waits for these
+_write_tasks: Set[asyncio.Task] = set()
+
+# OPTIMIZED: Last menu rendered into each (chat_id, message_id), so identical re-renders skip the API call
+_last_sent_text: "OrderedDict[Tuple[int, int], Tuple[str, Tuple]]" = OrderedDict()
+_LAST_SENT_MAX_ENTRIES = 1024
+
+# Global send queue; asyncio.Queue binds to the running loop on first use (Python 3.10+), so it can
+# be created at import time and producers never need a None check
+send_queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_MAXSIZE)
+
+# OPTIMIZED: Send workers route jobs into per-(user_id, target_id) queues, each drained in order by
+# its own short-lived consumer, so one account's backlog or FloodWait never blocks other users
+_target_queues: Dict[Tuple[int, int], asyncio.Queue] = {}
+_target_consumers: Dict[Tuple[int, int], asyncio.Task] = {}
+_inflight_jobs: Dict[Tuple[int, int], Tuple] = {}  # job each consumer has taken off its queue but not finished
+# Jobs accepted but not yet finished, wherever they sit (send_queue, a target queue or in hand). This is
+# what SEND_QUEUE_MAXSIZE bounds, since the router empties send_queue into the per-target queues at once
+_send_backlog = 0
+_user_send_slots: DefaultDict[int, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(USER_SEND_CONCURRENCY))
+# Caps sends in flight across all accounts, since each (user, target) consumer runs independently
+_global_send_slots = asyncio.Semaphore(SEND_WORKER_COUNT)
+# Telegram's send FloodWait applies to the whole account, so every target consumer of a user honours it
+_flood_until: Dict[int, float] = {}  # user_id -> monotonic time sends may resume
+# Caps target-resolve round-trips in flight, so a restore of many users doesn't burst the API
+_resolve_slots = asyncio.Semaphore(TARGET_RESOLVE_CONCURRENCY)
+
+UNAUTHORIZED_MESSAGE = """🚫 <b>Access Denied!</b> 
 
 You are not authorized to use this bot.
 
-📞 **Call this number:** `07089430305`
+📞 <b>Call this number:</b> <code>07089430305</code>
 
 Or
 
-🗨️ **Message Developer:** [HEMMY](https://t.me/justmemmy)
+🗨️ <b>Message Developer:</b> <a href="https://t.me/justmemmy">HEMMY</a>
+"""
+
+# Static /start text, only the four placeholders change per call
+_START_TEMPLATE = """
+╔═══════════════════════════╗
+║   📨 FORWARDER BOT 📨   ║
+║  TELEGRAM MESSAGE FORWARDER  ║
+╚═══════════════════════════╝
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+👤 <b>User:</b> {user_name}
+📱 <b>Phone:</b> <code>{user_phone}</code>
+{status_emoji} <b>Status:</b> {status_text}
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+📋 <b>COMMANDS:</b>
+
+🔐 <b>Account Management:</b>
+  /login - Connect your Telegram account
+  /logout - Disconnect your account
+
+📨 <b>Forwarding Tasks:</b>
+  /forwadd - Create a new forwarding task
+  /fortasks - List all your tasks
+
+🆔 <b>Utilities:</b>
+  /getallid - Get all your chat IDs
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+⚙️ <b>How it works:</b>
+1. Connect your account with /login
+2. Create a forwarding task
+3. Send messages in source chat
+4. Bot forwards to target with your chosen filters!
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 """
 
 # Track worker tasks so we can cancel them on shutdown
 worker_tasks: List[asyncio.Task] = []
+# Housekeeping tasks (GC ticker etc.), also cancelled on shutdown
+background_tasks: List[asyncio.Task] = []
 _send_workers_started = False
 
-# MAIN loop reference for cross-thread metrics collection
-MAIN_LOOP: Optional[asyncio.AbstractEventLoop] = None
+# Metrics for the Flask thread; rebuilt by the bot loop and swapped in whole, so readers never see a partial dict
+_metrics_snapshot: Dict[str, Any] = {}
+_sent_count = 0  # Messages delivered since start; only touched on the bot loop
 
 # OPTIMIZED: Memory management
-_last_gc_run = 0
 GC_INTERVAL = 300  # Run GC every 5 minutes
+ENTITY_CACHE_PURGE_INTERVAL = 300  # Prune stale target entities every 5 minutes
+FILTER_PERSIST_DELAY = 0.5  # Coalesce rapid filter toggles into one DB write
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", "600"))  # Abandoned login/logout/task flows expire
+STATE_SWEEP_INTERVAL = 60
+DIALOG_CACHE_TTL = 60  # /getallid page flips reuse the fetched dialog list for this long
+MEMORY_SAMPLE_INTERVAL = 5  # /metrics serves the last RSS sample instead of reading it per scrape
+METRICS_SNAPSHOT_INTERVAL = 1  # How stale /metrics may be
+
+# user_id -> (fetched_at monotonic, dialogs in Telegram order, whether the list is complete)
+_dialogs_cache: Dict[int, Tuple[float, List[Any], bool]] = {}
+_memory_usage_mb: Optional[float] = None
 
 
 # Generic helper to run DB calls in a thread so the event loop isn't blocked
 async def db_call(func, *args, **kwargs):
-    return await asyncio.to_thread(functools.partial(func, *args, **kwargs))
+    if kwargs:
+        func = functools.partial(func, *args, **kwargs)
+        args = ()
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, func, *args)
+
+
+def _spawn_write(coro) -> asyncio.Task:
+    """Start a background DB write and keep a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    _write_tasks.add(task)
+    task.add_done_callback(_write_tasks.discard)
+    return task
+
+
+async def _gather_bounded(coros, limit: int, timeout: Optional[float] = None) -> List[Any]:
+    """Run coroutines with at most `limit` in flight; a slot frees as soon as any one finishes"""
+    slots = asyncio.Semaphore(limit)
+
+    async def _run(coro):
+        async with slots:
+            if timeout is None:
+                return await coro
+            return await asyncio.wait_for(coro, timeout)
+
+    return await asyncio.gather(*(_run(c) for c in coros), return_exceptions=True)
 
 
 # OPTIMIZED: Memory management helper
-async def optimized_gc():
-    """Run garbage collection periodically to free memory"""
-    global _last_gc_run
-    current_time = asyncio.get_event_loop().time()
-    if current_time - _last_gc_run > GC_INTERVAL:
+async def _gc_ticker():
+    """Run garbage collection every GC_INTERVAL seconds from a single background task"""
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
         collected = gc.collect()
-        logger.debug(f"Garbage collection freed {collected} objects")
-        _last_gc_run = current_time
+        logger.debug("Garbage collection freed %d objects", collected)
+
+
+def _purge_target_entity_cache() -> int:
+    """Drop cached entities for disconnected users and targets no task references anymore"""
+    purged = 0
+    for uid in list(target_entity_cache.keys()):
+        entities = target_entity_cache[uid]
+        if uid not in user_clients:
+            purged += len(entities)
+            del target_entity_cache[uid]
+            continue
+        referenced = set()
+        for task in tasks_cache.get(uid, {}).values():
+            referenced.update(task["target_set"])
+        for tid in [tid for tid in entities if tid not in referenced]:
+            del entities[tid]
+            purged += 1
+        if not entities:
+            del target_entity_cache[uid]
+    return purged
+
+
+async def _state_ttl_sweeper():
+    """Expire abandoned login/logout/task-creation flows and disconnect their Telethon clients"""
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        now = time.monotonic()
+        for states in (login_states, logout_states, task_creation_states):
+            for uid in [uid for uid, st in states.items() if now - st.get("_ts", now) > STATE_TTL_SECONDS]:
+                st = states.pop(uid, None)
+                client = st.get("client") if st else None
+                if client:
+                    try:
+                        await client.disconnect()
+                    except Exception:
+                        logger.exception("Error disconnecting expired login client for %s", uid)
+                logger.debug("Expired abandoned conversation state for user %s", uid)
+        for uid in [uid for uid, entry in _dialogs_cache.items() if now - entry[0] > DIALOG_CACHE_TTL]:
+            _dialogs_cache.pop(uid, None)
+
+
+async def _entity_cache_purger():
+    """Keep target_entity_cache bounded for long-running processes"""
+    while True:
+        await asyncio.sleep(ENTITY_CACHE_PURGE_INTERVAL)
+        try:
+            purged = _purge_target_entity_cache()
+            if purged:
+                logger.debug("Purged %d stale target entities", purged)
+        except Exception:
+            logger.exception("Error purging target entity cache")
+
+
+def _make_default_task_filters() -> Dict[str, Any]:
+    """Return a fresh, mutable copy of the default task settings and filters"""
+    task_filters = dict(_DEFAULT_TASK_SETTINGS)
+    task_filters["filters"] = dict(_DEFAULT_FILTERS)
+    return task_filters
+
+
+def _rebuild_indices(user_id: int):
+    """Refresh the derived lookups of a user's tasks; call after every tasks_cache mutation"""
+    by_source: Dict[int, List[Dict]] = {}
+    for task in tasks_cache.get(user_id, {}).values():
+        task["target_set"] = frozenset(task.get("target_ids", ()))
+        task["sources_text"] = ", ".join(map(str, task.get("source_ids", ())))
+        task["targets_text"] = ", ".join(map(str, task.get("target_ids", ())))
+        task["plan"] = compile_filter_plan(task.get("filters", {}))
+        for source_id in dict.fromkeys(task.get("source_ids", ())):
+            by_source.setdefault(source_id, []).append(task)
+    if by_source:
+        source_index[user_id] = {source_id: tuple(tasks) for source_id, tasks in by_source.items()}
+    else:
+        source_index.pop(user_id, None)
+    count = len(tasks_cache.get(user_id, ()))
+    if count:
+        task_counts[user_id] = count
+    else:
+        task_counts.pop(user_id, None)
+
+
+# ---------- Task filter persistence ----------
+def _task_filters_changed(user_id: int, task_label: str):
+    """Recompile the task's filter plan and queue the settings for persistence"""
+    task = tasks_cache.get(user_id, {}).get(task_label)
+    if task is not None:
+        task["plan"] = compile_filter_plan(task.get("filters", {}))
+    _schedule_filters_persist(user_id, task_label)
+
+
+def _schedule_filters_persist(user_id: int, task_label: str):
+    """Persist a task's filters after FILTER_PERSIST_DELAY, restarting the timer on every change"""
+    key = (user_id, task_label)
+    handle = _pending_filter_writes.pop(key, None)
+    if handle is not None:
+        handle.cancel()
+    loop = asyncio.get_running_loop()
+    _pending_filter_writes[key] = loop.call_later(FILTER_PERSIST_DELAY, _start_filters_flush, user_id, task_label)
+
+
+def _start_filters_flush(user_id: int, task_label: str):
+    _pending_filter_writes.pop((user_id, task_label), None)
+    _spawn_write(_flush_task_filters(user_id, task_label))
+
+
+def _snapshot_filters(filters: Dict) -> Dict:
+    # Copy so the DB thread never serializes a dict the event loop is mutating
+    snapshot = dict(filters)
+    snapshot["filters"] = dict(filters.get("filters", {}))
+    return snapshot
+
+
+async def _flush_task_filters(user_id: int, task_label: str):
+    """Write the current in-memory filters of one task to the DB"""
+    task = tasks_cache.get(user_id, {}).get(task_label)
+    if not task:
+        return
+    try:
+        await db_call(db.update_task_filters, user_id, task_label, _snapshot_filters(task.get("filters", {})))
+    except Exception as e:
+        logger.exception("Error updating task filters in DB: %s", e)
+
+
+def _flush_pending_filter_writes_sync():
+    """Write out any debounced filter changes immediately (used on shutdown)"""
+    for (uid, label), handle in list(_pending_filter_writes.items()):
+        handle.cancel()
+        task = tasks_cache.get(uid, {}).get(label)
+        if not task:
+            continue
+        try:
+            db.update_task_filters(uid, label, _snapshot_filters(task.get("filters", {})))
+        except Exception:
+            logger.exception("Error flushing task filters for user %s task %s", uid, label)
+    _pending_filter_writes.clear()
 
 
 # ---------- Message filtering functions ----------
+# OPTIMIZED: Compiled once instead of on every call
+_CHAT_ID_RE = re.compile(r'-*\d+')
+_PHONE_JUNK_RE = re.compile(r'[^\d+]')
+
+
 def extract_words(text: str) -> List[str]:
     """Extract words from text, preserving emojis and special characters"""
-    return re.findall(r'\S+', text)
+    # str.split() splits on the same Unicode whitespace as \S+ without the regex engine
+    return text.split()
+
+def _parse_chat_ids(text: str) -> List[int]:
+    """Parse whitespace-separated chat IDs, ignoring tokens that are not numbers"""
+    return [int(id_str) for id_str in text.split() if _CHAT_ID_RE.fullmatch(id_str)]
 
 def is_numeric_word(word: str) -> bool:
     """Check if word contains only digits (numeric)"""
@@ -136,107 +430,117 @@ def is_alphabetic_word(word: str) -> bool:
 
 def contains_numeric(word: str) -> bool:
     """Check if word contains any digits"""
-    return any(char.isdigit() for char in word)
+    return any(map(str.isdigit, word))
 
 def contains_alphabetic(word: str) -> bool:
     """Check if word contains any letters"""
-    return any(char.isalpha() for char in word)
+    return any(map(str.isalpha, word))
 
 def contains_only_special(word: str) -> bool:
     """Check if word contains only special characters (no letters or digits)"""
     return not (contains_numeric(word) or contains_alphabetic(word))
 
-def apply_filters(message_text: str, task_filters: Dict) -> List[str]:
-    """Apply filters to message text and return list of messages to forward"""
-    if not message_text:
-        return []
-    
+def classify_word(word: str) -> Tuple[bool, bool]:
+    """Return (has_digit, has_alpha) for word in a single pass"""
+    has_digit = has_alpha = False
+    for ch in word:
+        if ch.isdigit():
+            has_digit = True
+        elif ch.isalpha():
+            has_alpha = True
+        else:
+            continue
+        if has_digit and has_alpha:
+            break
+    return has_digit, has_alpha
+
+def _keep_for_removed_alphabetic(word: str) -> bool:
+    """Letters or only special characters, never a purely numeric word"""
+    if word.isdigit():
+        return False
+    has_digit, has_alpha = classify_word(word)
+    return has_alpha or not has_digit
+
+def _keep_for_removed_numeric(word: str) -> bool:
+    """Digits or only special characters, never a purely alphabetic word"""
+    if word.isalpha():
+        return False
+    has_digit, has_alpha = classify_word(word)
+    return has_digit or not has_alpha
+
+def compile_filter_plan(task_filters: Dict) -> Callable[[str], List[str]]:
+    """Resolve a task's filter settings into one routine, rebuilt only when the settings change"""
     filters_enabled = task_filters.get('filters', {})
+    prefix = filters_enabled.get('prefix') or ""
+    suffix = filters_enabled.get('suffix') or ""
     
     # If raw text is enabled, forward everything with prefix/suffix
     if filters_enabled.get('raw_text', False):
-        processed = message_text
-        if filters_enabled.get('prefix'):
-            processed = filters_enabled['prefix'] + processed
-        if filters_enabled.get('suffix'):
-            processed = processed + filters_enabled['suffix']
-        return [processed]
-    
-    messages_to_send = []
-    words = extract_words(message_text)
+        if not prefix and not suffix:
+            def _raw_plan(message_text: str) -> List[str]:
+                return [message_text] if message_text else []
+        else:
+            def _raw_plan(message_text: str) -> List[str]:
+                return [f"{prefix}{message_text}{suffix}"] if message_text else []
+        return _raw_plan
     
-    # Process based on enabled filters
     if filters_enabled.get('numbers_only', False):
-        numeric_words = [word for word in words if is_numeric_word(word)]
-        for word in numeric_words:
-            processed = word
-            if filters_enabled.get('prefix'):
-                processed = filters_enabled['prefix'] + processed
-            if filters_enabled.get('suffix'):
-                processed = processed + filters_enabled['suffix']
-            messages_to_send.append(processed)
-    
+        keep = is_numeric_word
     elif filters_enabled.get('alphabets_only', False):
-        alphabetic_words = [word for word in words if is_alphabetic_word(word)]
-        for word in alphabetic_words:
-            processed = word
-            if filters_enabled.get('prefix'):
-                processed = filters_enabled['prefix'] + processed
-            if filters_enabled.get('suffix'):
-                processed = processed + filters_enabled['suffix']
-            messages_to_send.append(processed)
-    
+        keep = is_alphabetic_word
     elif filters_enabled.get('removed_alphabetic', False):
-        non_numeric_words = []
-        for word in words:
-            if is_numeric_word(word):
-                continue
-            if contains_alphabetic(word) or contains_only_special(word):
-                non_numeric_words.append(word)
-        
-        for word in non_numeric_words:
-            processed = word
-            if filters_enabled.get('prefix'):
-                processed = filters_enabled['prefix'] + processed
-            if filters_enabled.get('suffix'):
-                processed = processed + filters_enabled['suffix']
-            messages_to_send.append(processed)
-    
+        keep = _keep_for_removed_alphabetic
     elif filters_enabled.get('removed_numeric', False):
-        non_alphabetic_words = []
-        for word in words:
-            if is_alphabetic_word(word):
-                continue
-            if contains_numeric(word) or contains_only_special(word):
-                non_alphabetic_words.append(word)
-        
-        for word in non_alphabetic_words:
-            processed = word
-            if filters_enabled.get('prefix'):
-                processed = filters_enabled['prefix'] + processed
-            if filters_enabled.get('suffix'):
-                processed = processed + filters_enabled['suffix']
-            messages_to_send.append(processed)
-    
+        keep = _keep_for_removed_numeric
     else:
         # No specific filter enabled, forward all words with prefix/suffix
-        for word in words:
-            processed = word
-            if filters_enabled.get('prefix'):
-                processed = filters_enabled['prefix'] + processed
-            if filters_enabled.get('suffix'):
-                processed = processed + filters_enabled['suffix']
-            messages_to_send.append(processed)
-    
-    return messages_to_send
+        keep = None
+    affixed = bool(prefix or suffix)
+    
+    def _word_plan(message_text: str) -> List[str]:
+        if not message_text:
+            return []
+        words = extract_words(message_text)
+        if keep is not None:
+            words = [word for word in words if keep(word)]
+        if not affixed:
+            return words
+        return [f"{prefix}{word}{suffix}" for word in words]
+    return _word_plan
+
+def apply_filters(message_text: str, task_filters: Dict) -> List[str]:
+    """Apply filters to message text and return list of messages to forward"""
+    return compile_filter_plan(task_filters)(message_text)
 
 
 # ---------- Authorization helpers ----------
-async def check_authorization(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    user_id = update.effective_user.id
+async def _is_allowed_cached(user_id: int) -> bool:
+    """Return the DB allow-list result for user_id, served from a short-lived cache"""
+    now = time.monotonic()
+    cached = _auth_cache.get(user_id)
+    if cached is not None and now - cached[1] < AUTH_CACHE_TTL_SECONDS:
+        _auth_cache.move_to_end(user_id)
+        return cached[0]
+
+    is_allowed = await db_call(db.is_user_allowed, user_id)
+    _auth_cache[user_id] = (is_allowed, now)
+    _auth_cache.move_to_end(user_id)
+    while len(_auth_cache) > _AUTH_CACHE_MAX_ENTRIES:
+        _auth_cache.popitem(last=False)
+    return is_allowed
+
+
+def invalidate_auth_cache(user_id: int):
+    """Drop the cached allow-list result after the allow-list changes"""
+    _auth_cache.pop(user_id, None)
+
+
+async def check_authorization(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: Optional[int] = None) -> bool:
+    if user_id is None:
+        user_id = update.effective_user.id
 
     try:
-        is_allowed_db = await db_call(db.is_user_allowed, user_id)
+        is_allowed_db = await _is_allowed_cached(user_id)
     except Exception:
         logger.exception("Error checking DB allowed users for %s", user_id)
         is_allowed_db = False
@@ -247,14 +551,14 @@ async def check_authorization(update: Update, context: ContextTypes.DEFAULT_TYPE
         if update.message:
             await update.message.reply_text(
                 UNAUTHORIZED_MESSAGE,
-                parse_mode="Markdown",
+                parse_mode=ParseMode.HTML,
                 disable_web_page_preview=True,
             )
         elif update.callback_query:
             await update.callback_query.answer()
             await update.callback_query.message.reply_text(
                 UNAUTHORIZED_MESSAGE,
-                parse_mode="Markdown",
+                parse_mode=ParseMode.HTML,
                 disable_web_page_preview=True,
             )
         return False
@@ -264,57 +568,27 @@ async def check_authorization(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 # ---------- Simple UI handlers ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    tg_user = update.effective_user
+    user_id = tg_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     user = await db_call(db.get_user, user_id)
 
-    user_name = update.effective_user.first_name or "User"
+    user_name = tg_user.first_name or "User"
     user_phone = user["phone"] if user and user["phone"] else "Not connected"
     is_logged_in = user and user["is_logged_in"]
 
     status_emoji = "🟢" if is_logged_in else "🔴"
     status_text = "Online" if is_logged_in else "Offline"
 
-    message_text = f"""
-╔═══════════════════════════╗
-║   📨 FORWARDER BOT 📨   ║
-║  TELEGRAM MESSAGE FORWARDER  ║
-╚═══════════════════════════╝
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-👤 **User:** {user_name}
-📱 **Phone:** `{user_phone}`
-{status_emoji} **Status:** {status_text}
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-📋 **COMMANDS:**
-
-🔐 **Account Management:**
-  /login - Connect your Telegram account
-  /logout - Disconnect your account
-
-📨 **Forwarding Tasks:**
-  /forwadd - Create a new forwarding task
-  /fortasks - List all your tasks
-
-🆔 **Utilities:**
-  /getallid - Get all your chat IDs
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-⚙️ **How it works:**
-1. Connect your account with /login
-2. Create a forwarding task
-3. Send messages in source chat
-4. Bot forwards to target with your chosen filters!
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-"""
+    message_text = _START_TEMPLATE.format(
+        user_name=html.escape(user_name),
+        user_phone=user_phone,
+        status_emoji=status_emoji,
+        status_text=status_text,
+    )
 
     keyboard = []
     if is_logged_in:
@@ -326,50 +600,111 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         message_text,
         reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None,
-        parse_mode="Markdown",
+        parse_mode=ParseMode.HTML,
     )
 
 
+# Toggle names, longest first so legacy "toggle_<label>_<type>" data splits on the right suffix
+_TOGGLE_TYPES = (
+    "clear_prefix_suffix",
+    "removed_alphabetic",
+    "removed_numeric",
+    "alphabets_only",
+    "prefix_suffix",
+    "numbers_only",
+    "forward_tag",
+    "raw_text",
+    "outgoing",
+    "control",
+)
+_CHAT_CATEGORIES = ("bots", "channels", "groups", "private")
+# Telegram caps callback_data at 64 bytes; labels must fit next to the longest action
+_TASK_LABEL_MAX_BYTES = 64 - len("toggle||clear_prefix_suffix")
+
+
+def _parse_legacy_callback_data(data: str) -> Tuple[str, Tuple[str, ...]]:
+    """Parse the old underscore-separated callback data still attached to earlier messages"""
+    if data == "chatids_back":
+        return "chatids", ("back",)
+    if data.startswith("chatids_"):
+        category, _, page = data[len("chatids_"):].rpartition("_")
+        return "chatids", (category, page)
+    if data.startswith("confirm_delete_"):
+        return "confirm_delete", (data[len("confirm_delete_"):],)
+    if data.startswith("toggle_"):
+        rest = data[len("toggle_"):]
+        for toggle_type in _TOGGLE_TYPES:
+            if rest.endswith("_" + toggle_type):
+                return "toggle", (rest[:-len(toggle_type) - 1], toggle_type)
+        return "toggle", (rest, "")
+    if data.startswith(("prefix_", "suffix_")):
+        action, _, rest = data.partition("_")
+        return action, (rest[:-len("_set")] if rest.endswith("_set") else rest,)
+    action, sep, rest = data.partition("_")
+    if sep and action in ("task", "filter", "delete"):
+        return action, (rest,)
+    return data, ()
+
+
+def _parse_callback_data(data: str) -> Tuple[str, Tuple[str, ...]]:
+    """Split callback data ("action|label[|arg]") into the action and its arguments"""
+    action, sep, rest = data.partition("|")
+    if not sep:
+        return _parse_legacy_callback_data(data)
+    if action == "toggle":
+        # Labels are free text, the toggle type never contains "|"
+        task_label, _, toggle_type = rest.rpartition("|")
+        return action, (task_label, toggle_type)
+    if action == "chatids":
+        return action, tuple(rest.split("|"))
+    return action, (rest,)
+
+
+def _callback_args_valid(action: str, args: Tuple[str, ...]) -> bool:
+    """Shape check so malformed callback data is ignored rather than raising in a handler"""
+    if action in ("login", "logout", "show_tasks"):
+        return not args
+    if action == "chatids":
+        if args == ("back",):
+            return True
+        return len(args) == 2 and args[0] in _CHAT_CATEGORIES and args[1].isascii() and args[1].isdecimal()
+    if action == "toggle":
+        return len(args) == 2 and bool(args[0]) and args[1] in _TOGGLE_TYPES
+    return len(args) == 1 and bool(args[0])
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, query.from_user.id):
         return
 
     await query.answer()
 
-    if query.data == "login":
-        await query.message.delete()
-        await login_command(update, context)
-    elif query.data == "logout":
-        await query.message.delete()
-        await logout_command(update, context)
-    elif query.data == "show_tasks":
-        await query.message.delete()
-        await fortasks_command(update, context)
-    elif query.data.startswith("chatids_"):
-        user_id = query.from_user.id
-        if query.data == "chatids_back":
-            await show_chat_categories(user_id, query.message.chat.id, query.message.message_id, context)
-        else:
-            parts = query.data.split("_")
-            category = parts[1]
-            page = int(parts[2])
-            await show_categorized_chats(user_id, query.message.chat.id, query.message.message_id, category, page, context)
-    elif query.data.startswith("task_"):
-        await handle_task_menu(update, context)
-    elif query.data.startswith("filter_"):
-        await handle_filter_menu(update, context)
-    elif query.data.startswith("toggle_"):
-        await handle_toggle_action(update, context)
-    elif query.data.startswith("delete_"):
-        await handle_delete_action(update, context)
-    elif query.data.startswith("prefix_"):
-        await handle_prefix_suffix(update, context)
-    elif query.data.startswith("suffix_"):
-        await handle_prefix_suffix(update, context)
-    elif query.data.startswith("confirm_delete_"):
-        await handle_confirm_delete(update, context)
+    action, args = _parse_callback_data(query.data)
+    handler = _CALLBACK_HANDLERS.get(action)
+    if handler is None or not _callback_args_valid(action, args):
+        logger.debug("Ignoring malformed callback data: %r", query.data)
+        return
+    await handler(update, context, *args)
+
+
+def _menu_command(command: Callable) -> Callable:
+    """Open a slash command from an inline button, replacing the menu message"""
+    async def _handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.callback_query.message.delete()
+        await command(update, context)
+    return _handler
+
+
+async def handle_chatids_action(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str, page: str = "0"):
+    """Navigate the /getallid chat categories"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    if category == "back":
+        await show_chat_categories(user_id, query.message.chat.id, query.message.message_id, context)
+    else:
+        await show_categorized_chats(user_id, query.message.chat.id, query.message.message_id, category, int(page), context)
 
 
 # ---------- Task creation flow ----------
@@ -377,14 +712,14 @@ async def forwadd_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the interactive task creation process"""
     user_id = update.effective_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     user = await db_call(db.get_user, user_id)
     if not user or not user["is_logged_in"]:
         await update.message.reply_text(
-            "❌ **You need to connect your account first!**\n\nUse /login to connect your Telegram account.",
-            parse_mode="Markdown"
+            "❌ <b>You need to connect your account first!</b>\n\nUse /login to connect your Telegram account.",
+            parse_mode=ParseMode.HTML
         )
         return
 
@@ -392,98 +727,92 @@ async def forwadd_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "step": "waiting_name",
         "name": "",
         "source_ids": [],
-        "target_ids": []
+        "target_ids": [],
+        "_ts": time.monotonic()
     }
 
     await update.message.reply_text(
-        "🎯 **Let's create a new forwarding task!**\n\n"
-        "📝 **Step 1 of 3:** Please enter a name for your task.\n\n"
-        "💡 *Example: My Forwarding Task*",
-        parse_mode="Markdown"
+        "🎯 <b>Let's create a new forwarding task!</b>\n\n"
+        "📝 <b>Step 1 of 3:</b> Please enter a name for your task.\n\n"
+        "💡 <i>Example: My Forwarding Task</i>",
+        parse_mode=ParseMode.HTML
     )
 
 
-async def handle_task_creation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_task_creation(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     """Handle interactive task creation steps"""
-    user_id = update.effective_user.id
-    text = update.message.text.strip()
-
-    if user_id not in task_creation_states:
+    state = task_creation_states.get(user_id)
+    if state is None:
         return
 
-    state = task_creation_states[user_id]
+    text = update.message.text.strip()
 
     try:
         if state["step"] == "waiting_name":
             if not text:
-                await update.message.reply_text("❌ **Please enter a valid task name!**")
+                await update.message.reply_text("❌ <b>Please enter a valid task name!</b>", parse_mode=ParseMode.HTML)
+                return
+
+            if len(text.encode("utf-8")) > _TASK_LABEL_MAX_BYTES:
+                await update.message.reply_text(
+                    "❌ <b>Task name is too long!</b>\n\n"
+                    f"Please use at most {_TASK_LABEL_MAX_BYTES} characters (emojis count as several).",
+                    parse_mode=ParseMode.HTML
+                )
                 return
 
             state["name"] = text
             state["step"] = "waiting_source"
 
             await update.message.reply_text(
-                f"✅ **Task name saved:** {text}\n\n"
-                "📥 **Step 2 of 3:** Please enter the source chat ID(s).\n\n"
+                f"✅ <b>Task name saved:</b> {html.escape(text)}\n\n"
+                "📥 <b>Step 2 of 3:</b> Please enter the source chat ID(s).\n\n"
                 "You can enter multiple IDs separated by spaces.\n"
-                "💡 *Use /getallid to find your chat IDs*\n\n"
-                "**Example:** `123456789 987654321`",
-                parse_mode="Markdown"
+                "💡 <i>Use /getallid to find your chat IDs</i>\n\n"
+                "<b>Example:</b> <code>123456789 987654321</code>",
+                parse_mode=ParseMode.HTML
             )
 
         elif state["step"] == "waiting_source":
             if not text:
-                await update.message.reply_text("❌ **Please enter at least one source ID!**")
+                await update.message.reply_text("❌ <b>Please enter at least one source ID!</b>", parse_mode=ParseMode.HTML)
                 return
 
             try:
-                source_ids = [int(id_str.strip()) for id_str in text.split() if id_str.strip().lstrip('-').isdigit()]
+                source_ids = _parse_chat_ids(text)
                 if not source_ids:
-                    await update.message.reply_text("❌ **Please enter valid numeric IDs!**")
+                    await update.message.reply_text("❌ <b>Please enter valid numeric IDs!</b>", parse_mode=ParseMode.HTML)
                     return
 
                 state["source_ids"] = source_ids
                 state["step"] = "waiting_target"
 
                 await update.message.reply_text(
-                    f"✅ **Source IDs saved:** {', '.join(map(str, source_ids))}\n\n"
-                    "📤 **Step 3 of 3:** Please enter the target chat ID(s).\n\n"
+                    f"✅ <b>Source IDs saved:</b> {', '.join(map(str, source_ids))}\n\n"
+                    "📤 <b>Step 3 of 3:</b> Please enter the target chat ID(s).\n\n"
                     "You can enter multiple IDs separated by spaces.\n"
-                    "💡 *Use /getallid to find your chat IDs*\n\n"
-                    "**Example:** `111222333`",
-                    parse_mode="Markdown"
+                    "💡 <i>Use /getallid to find your chat IDs</i>\n\n"
+                    "<b>Example:</b> <code>111222333</code>",
+                    parse_mode=ParseMode.HTML
                 )
 
             except ValueError:
-                await update.message.reply_text("❌ **Please enter valid numeric IDs only!**")
+                await update.message.reply_text("❌ <b>Please enter valid numeric IDs only!</b>", parse_mode=ParseMode.HTML)
 
         elif state["step"] == "waiting_target":
             if not text:
-                await update.message.reply_text("❌ **Please enter at least one target ID!**")
+                await update.message.reply_text("❌ <b>Please enter at least one target ID!</b>", parse_mode=ParseMode.HTML)
                 return
 
             try:
-                target_ids = [int(id_str.strip()) for id_str in text.split() if id_str.strip().lstrip('-').isdigit()]
+                target_ids = _parse_chat_ids(text)
                 if not target_ids:
-                    await update.message.reply_text("❌ **Please enter valid numeric IDs!**")
+                    await update.message.reply_text("❌ <b>Please enter valid numeric IDs!</b>", parse_mode=ParseMode.HTML)
                     return
 
                 state["target_ids"] = target_ids
 
-                task_filters = {
-                    "filters": {
-                        "raw_text": False,
-                        "numbers_only": False,
-                        "alphabets_only": False,
-                        "removed_alphabetic": False,
-                        "removed_numeric": False,
-                        "prefix": "",
-                        "suffix": ""
-                    },
-                    "outgoing": True,
-                    "forward_tag": False,
-                    "control": True
-                }
+                task_filters = _make_default_task_filters()
 
                 added = await db_call(db.add_forwarding_task, 
                                      user_id, 
@@ -493,15 +822,16 @@ async def handle_task_creation(update: Update, context: ContextTypes.DEFAULT_TYP
                                      task_filters)
 
                 if added:
-                    tasks_cache.setdefault(user_id, [])
-                    tasks_cache[user_id].append({
+                    new_task = {
                         "id": None,
                         "label": state["name"],
                         "source_ids": state["source_ids"],
                         "target_ids": state["target_ids"],
                         "is_active": 1,
                         "filters": task_filters
-                    })
+                    }
+                    tasks_cache.setdefault(user_id, {})[state["name"]] = new_task
+                    _rebuild_indices(user_id)
 
                     try:
                         asyncio.create_task(resolve_targets_for_user(user_id, target_ids))
@@ -509,97 +839,124 @@ async def handle_task_creation(update: Update, context: ContextTypes.DEFAULT_TYP
                         logger.exception("Failed to schedule resolve_targets_for_user task")
 
                     await update.message.reply_text(
-                        f"🎉 **Task created successfully!**\n\n"
-                        f"📋 **Name:** {state['name']}\n"
-                        f"📥 **Sources:** {', '.join(map(str, state['source_ids']))}\n"
-                        f"📤 **Targets:** {', '.join(map(str, state['target_ids']))}\n\n"
+                        f"🎉 <b>Task created successfully!</b>\n\n"
+                        f"📋 <b>Name:</b> {html.escape(state['name'])}\n"
+                        f"📥 <b>Sources:</b> {new_task['sources_text']}\n"
+                        f"📤 <b>Targets:</b> {new_task['targets_text']}\n\n"
                         "✅ All filters are set to default:\n"
                         "• Outgoing: ✅ On\n"
                         "• Forward Tag: ❌ Off\n"
                         "• Control: ✅ On\n\n"
                         "Use /fortasks to manage your task!",
-                        parse_mode="Markdown"
+                        parse_mode=ParseMode.HTML
                     )
 
                     del task_creation_states[user_id]
 
                 else:
                     await update.message.reply_text(
-                        f"❌ **Task '{state['name']}' already exists!**\n\n"
+                        f"❌ <b>Task '{html.escape(state['name'])}' already exists!</b>\n\n"
                         "Please choose a different name.",
-                        parse_mode="Markdown"
+                        parse_mode=ParseMode.HTML
                     )
 
             except ValueError:
-                await update.message.reply_text("❌ **Please enter valid numeric IDs only!**")
+                await update.message.reply_text("❌ <b>Please enter valid numeric IDs only!</b>", parse_mode=ParseMode.HTML)
 
     except Exception as e:
         logger.exception("Error in task creation for user %s: %s", user_id, e)
         await update.message.reply_text(
-            f"❌ **Error creating task:** {str(e)}\n\n"
+            f"❌ <b>Error creating task:</b> {html.escape(str(e))}\n\n"
             "Please try again with /forwadd",
-            parse_mode="Markdown"
+            parse_mode=ParseMode.HTML
         )
         if user_id in task_creation_states:
             del task_creation_states[user_id]
 
 
 # ---------- Task Menu System ----------
+def _keyboard_signature(keyboard: List[List[InlineKeyboardButton]]) -> Tuple:
+    return tuple(tuple((b.text, b.callback_data) for b in row) for row in keyboard)
+
+
+def _forget_menu(query):
+    """Drop the cached render for a message that is being edited outside _edit_menu"""
+    _last_sent_text.pop((query.message.chat.id, query.message.message_id), None)
+
+
+async def _edit_menu(query, message_text: str, keyboard: List[List[InlineKeyboardButton]]):
+    """Edit a menu message in place, skipping the call when it would not change anything"""
+    key = (query.message.chat.id, query.message.message_id)
+    rendered = (message_text, _keyboard_signature(keyboard))
+    if _last_sent_text.get(key) == rendered:
+        _last_sent_text.move_to_end(key)
+        return
+
+    try:
+        await query.edit_message_text(
+            message_text,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode=ParseMode.HTML
+        )
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+
+    _last_sent_text[key] = rendered
+    _last_sent_text.move_to_end(key)
+    if len(_last_sent_text) > _LAST_SENT_MAX_ENTRIES:
+        _last_sent_text.popitem(last=False)
+
+
 async def fortasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all tasks with inline buttons"""
-    user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
+    user_id = update.effective_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     message = update.message if update.message else update.callback_query.message
-    tasks = tasks_cache.get(user_id) or []
+    tasks = list(tasks_cache.get(user_id, {}).values())
 
     if not tasks:
         await message.reply_text(
-            "📋 **No Active Tasks**\n\n"
+            "📋 <b>No Active Tasks</b>\n\n"
             "You don't have any forwarding tasks yet.\n\n"
             "Create one with:\n"
             "/forwadd",
-            parse_mode="Markdown"
+            parse_mode=ParseMode.HTML
         )
         return
 
-    task_list = "📋 **Your Forwarding Tasks**\n\n"
+    task_list = "📋 <b>Your Forwarding Tasks</b>\n\n"
     task_list += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
     
     keyboard = []
     
     for i, task in enumerate(tasks, 1):
-        task_list += f"{i}. **{task['label']}**\n"
-        task_list += f"   📥 Sources: {', '.join(map(str, task['source_ids']))}\n"
-        task_list += f"   📤 Targets: {', '.join(map(str, task['target_ids']))}\n\n"
+        task_list += f"{i}. <b>{html.escape(task['label'])}</b>\n"
+        task_list += f"   📥 Sources: {task['sources_text']}\n"
+        task_list += f"   📤 Targets: {task['targets_text']}\n\n"
         
-        keyboard.append([InlineKeyboardButton(f"{i}. {task['label']}", callback_data=f"task_{task['label']}")])
+        keyboard.append([InlineKeyboardButton(f"{i}. {task['label']}", callback_data=f"task|{task['label']}")])
 
     task_list += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-    task_list += f"Total: **{len(tasks)} task(s)**\n\n"
-    task_list += "💡 **Tap any task below to manage it!**"
+    task_list += f"Total: <b>{len(tasks)} task(s)</b>\n\n"
+    task_list += "💡 <b>Tap any task below to manage it!</b>"
 
     await message.reply_text(
         task_list,
         reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
+        parse_mode=ParseMode.HTML
     )
 
 
-async def handle_task_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_task_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, task_label: str):
     """Show task management menu"""
     query = update.callback_query
     user_id = query.from_user.id
-    task_label = query.data.replace("task_", "")
     
-    user_tasks = tasks_cache.get(user_id, [])
-    task = None
-    for t in user_tasks:
-        if t["label"] == task_label:
-            task = t
-            break
+    task = tasks_cache.get(user_id, {}).get(task_label)
     
     if not task:
         await query.answer("Task not found!", show_alert=True)
@@ -611,47 +968,37 @@ async def handle_task_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     forward_tag_emoji = "✅" if filters.get("forward_tag", False) else "❌"
     control_emoji = "✅" if filters.get("control", True) else "❌"
     
-    message_text = f"🔧 **Task Management: {task_label}**\n\n"
-    message_text += f"📥 **Sources:** {', '.join(map(str, task['source_ids']))}\n"
-    message_text += f"📤 **Targets:** {', '.join(map(str, task['target_ids']))}\n\n"
-    message_text += "⚙️ **Settings:**\n"
+    message_text = f"🔧 <b>Task Management: {html.escape(task_label)}</b>\n\n"
+    message_text += f"📥 <b>Sources:</b> {task['sources_text']}\n"
+    message_text += f"📤 <b>Targets:</b> {task['targets_text']}\n\n"
+    message_text += "⚙️ <b>Settings:</b>\n"
     message_text += f"{outgoing_emoji} Outgoing - Controls if outgoing messages are forwarded\n"
     message_text += f"{forward_tag_emoji} Forward Tag - Shows/hides 'Forwarded from' tag\n"
     message_text += f"{control_emoji} Control - Pauses/runs forwarding\n\n"
-    message_text += "💡 **Tap any option below to change it!**"
+    message_text += "💡 <b>Tap any option below to change it!</b>"
     
     keyboard = [
-        [InlineKeyboardButton("🔍 Filters", callback_data=f"filter_{task_label}")],
+        [InlineKeyboardButton("🔍 Filters", callback_data=f"filter|{task_label}")],
         [
-            InlineKeyboardButton(f"{outgoing_emoji} Outgoing", callback_data=f"toggle_{task_label}_outgoing"),
-            InlineKeyboardButton(f"{forward_tag_emoji} Forward Tag", callback_data=f"toggle_{task_label}_forward_tag")
+            InlineKeyboardButton(f"{outgoing_emoji} Outgoing", callback_data=f"toggle|{task_label}|outgoing"),
+            InlineKeyboardButton(f"{forward_tag_emoji} Forward Tag", callback_data=f"toggle|{task_label}|forward_tag")
         ],
         [
-            InlineKeyboardButton(f"{control_emoji} Control", callback_data=f"toggle_{task_label}_control"),
-            InlineKeyboardButton("🗑️ Delete", callback_data=f"delete_{task_label}")
+            InlineKeyboardButton(f"{control_emoji} Control", callback_data=f"toggle|{task_label}|control"),
+            InlineKeyboardButton("🗑️ Delete", callback_data=f"delete|{task_label}")
         ],
         [InlineKeyboardButton("🔙 Back to Tasks", callback_data="show_tasks")]
     ]
     
-    await query.edit_message_text(
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
-    )
+    await _edit_menu(query, message_text, keyboard)
 
 
-async def handle_filter_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_filter_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, task_label: str):
     """Show filter management menu"""
     query = update.callback_query
     user_id = query.from_user.id
-    task_label = query.data.replace("filter_", "")
     
-    user_tasks = tasks_cache.get(user_id, [])
-    task = None
-    for t in user_tasks:
-        if t["label"] == task_label:
-            task = t
-            break
+    task = tasks_cache.get(user_id, {}).get(task_label)
     
     if not task:
         await query.answer("Task not found!", show_alert=True)
@@ -668,123 +1015,50 @@ async def handle_filter_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     prefix = filter_settings.get("prefix", "")
     suffix = filter_settings.get("suffix", "")
-    prefix_text = f"'{prefix}'" if prefix else "Not set"
-    suffix_text = f"'{suffix}'" if suffix else "Not set"
+    prefix_text = f"'{html.escape(prefix)}'" if prefix else "Not set"
+    suffix_text = f"'{html.escape(suffix)}'" if suffix else "Not set"
     
-    message_text = f"🔍 **Filters for: {task_label}**\n\n"
+    message_text = f"🔍 <b>Filters for: {html.escape(task_label)}</b>\n\n"
     message_text += "Apply filters to messages before forwarding:\n\n"
-    message_text += "📋 **Available Filters:**\n"
+    message_text += "📋 <b>Available Filters:</b>\n"
     message_text += f"{raw_text_emoji} Raw text - Forward any text\n"
     message_text += f"{numbers_only_emoji} Numbers only - Forward only numbers\n"
     message_text += f"{alphabets_only_emoji} Alphabets only - Forward only letters\n"
-    message_text += f"{removed_alphabetic_emoji} Removed Alphabetic - Keep letters & special chars, remove numbers\n"
-    message_text += f"{removed_numeric_emoji} Removed Numeric - Keep numbers & special chars, remove letters\n"
-    message_text += f"📝 **Prefix:** {prefix_text}\n"
-    message_text += f"📝 **Suffix:** {suffix_text}\n\n"
-    message_text += "💡 **Multiple filters can be active at once!**"
+    message_text += f"{removed_alphabetic_emoji} Removed Alphabetic - Keep letters &amp; special chars, remove numbers\n"
+    message_text += f"{removed_numeric_emoji} Removed Numeric - Keep numbers &amp; special chars, remove letters\n"
+    message_text += f"📝 <b>Prefix:</b> {prefix_text}\n"
+    message_text += f"📝 <b>Suffix:</b> {suffix_text}\n\n"
+    message_text += "💡 <b>Multiple filters can be active at once!</b>"
     
     keyboard = [
         [
-            InlineKeyboardButton(f"{raw_text_emoji} Raw text", callback_data=f"toggle_{task_label}_raw_text"),
-            InlineKeyboardButton(f"{numbers_only_emoji} Numbers only", callback_data=f"toggle_{task_label}_numbers_only")
+            InlineKeyboardButton(f"{raw_text_emoji} Raw text", callback_data=f"toggle|{task_label}|raw_text"),
+            InlineKeyboardButton(f"{numbers_only_emoji} Numbers only", callback_data=f"toggle|{task_label}|numbers_only")
         ],
         [
-            InlineKeyboardButton(f"{alphabets_only_emoji} Alphabets only", callback_data=f"toggle_{task_label}_alphabets_only"),
-            InlineKeyboardButton(f"{removed_alphabetic_emoji} Removed Alphabetic", callback_data=f"toggle_{task_label}_removed_alphabetic")
+            InlineKeyboardButton(f"{alphabets_only_emoji} Alphabets only", callback_data=f"toggle|{task_label}|alphabets_only"),
+            InlineKeyboardButton(f"{removed_alphabetic_emoji} Removed Alphabetic", callback_data=f"toggle|{task_label}|removed_alphabetic")
         ],
         [
-            InlineKeyboardButton(f"{removed_numeric_emoji} Removed Numeric", callback_data=f"toggle_{task_label}_removed_numeric"),
-            InlineKeyboardButton("📝 Prefix/Suffix", callback_data=f"toggle_{task_label}_prefix_suffix")
+            InlineKeyboardButton(f"{removed_numeric_emoji} Removed Numeric", callback_data=f"toggle|{task_label}|removed_numeric"),
+            InlineKeyboardButton("📝 Prefix/Suffix", callback_data=f"toggle|{task_label}|prefix_suffix")
         ],
-        [InlineKeyboardButton("🔙 Back to Task", callback_data=f"task_{task_label}")]
+        [InlineKeyboardButton("🔙 Back to Task", callback_data=f"task|{task_label}")]
     ]
     
-    await query.edit_message_text(
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
-    )
+    await _edit_menu(query, message_text, keyboard)
 
 
-async def update_button_inline(query, task_label, toggle_type, new_state):
-    """Update button inline without refreshing entire message"""
-    keyboard = query.message.reply_markup.inline_keyboard
-    button_found = False
-    
-    # Determine new emoji based on new state
-    new_emoji = "✅" if new_state else "❌"
-    
-    # Update the specific button in the keyboard
-    for row in keyboard:
-        for i, button in enumerate(row):
-            if button.callback_data and button.callback_data.startswith(f"toggle_{task_label}_{toggle_type}"):
-                # Extract the text after the emoji (preserve the label)
-                current_text = button.text
-                # Find the first non-emoji character (skip the first character which is the emoji)
-                # Handle both single emoji and emoji+space
-                if current_text.startswith("✅ ") or current_text.startswith("❌ "):
-                    # Format is "✅ Label" or "❌ Label"
-                    text_without_emoji = current_text[2:]  # Skip emoji and space
-                    row[i] = InlineKeyboardButton(
-                        f"{new_emoji} {text_without_emoji}",
-                        callback_data=button.callback_data
-                    )
-                elif current_text.startswith("✅") or current_text.startswith("❌"):
-                    # Format is "✅Label" or "❌Label"
-                    text_without_emoji = current_text[1:]  # Skip just the emoji
-                    row[i] = InlineKeyboardButton(
-                        f"{new_emoji}{text_without_emoji}",
-                        callback_data=button.callback_data
-                    )
-                else:
-                    # Fallback: just replace the button text completely
-                    row[i] = InlineKeyboardButton(
-                        f"{new_emoji} {toggle_type.replace('_', ' ').title()}",
-                        callback_data=button.callback_data
-                    )
-                button_found = True
-                break
-        if button_found:
-            break
-    
-    if button_found:
-        # Update just the inline keyboard without changing message text
-        await query.edit_message_reply_markup(
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    else:
-        # If button not found, fall back to refreshing the entire menu
-        if toggle_type in ["outgoing", "forward_tag", "control"]:
-            await handle_task_menu(update, context)
-        else:
-            await handle_filter_menu(update, context)
-
-
-async def handle_toggle_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_toggle_action(update: Update, context: ContextTypes.DEFAULT_TYPE, task_label: str, toggle_type: str):
     """Handle toggle actions for filters and settings with instant button updates"""
     query = update.callback_query
     user_id = query.from_user.id
-    data_parts = query.data.replace("toggle_", "").split("_")
-    
-    if len(data_parts) < 2:
-        await query.answer("Invalid action!", show_alert=True)
-        return
-    
-    task_label = data_parts[0]
-    toggle_type = "_".join(data_parts[1:])
     
-    user_tasks = tasks_cache.get(user_id, [])
-    task_index = -1
-    for i, t in enumerate(user_tasks):
-        if t["label"] == task_label:
-            task_index = i
-            break
-    
-    if task_index == -1:
+    task = tasks_cache.get(user_id, {}).get(task_label)
+    if not task:
         await query.answer("Task not found!", show_alert=True)
         return
     
-    task = user_tasks[task_index]
     filters = task.get("filters", {})
     new_state = None
     
@@ -822,17 +1096,10 @@ async def handle_toggle_action(update: Update, context: ContextTypes.DEFAULT_TYP
         filters["filters"] = filter_settings
         new_state = False
         task["filters"] = filters
-        tasks_cache[user_id][task_index] = task
-        
-        try:
-            asyncio.create_task(
-                db_call(db.update_task_filters, user_id, task_label, filters)
-            )
-        except Exception as e:
-            logger.exception("Error updating task filters in DB: %s", e)
+        _task_filters_changed(user_id, task_label)
         
         await query.answer("✅ Prefix and suffix cleared!")
-        await handle_filter_menu(update, context)
+        await handle_filter_menu(update, context, task_label)
         return
     
     else:
@@ -841,7 +1108,6 @@ async def handle_toggle_action(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Update cache with new state
     task["filters"] = filters
-    tasks_cache[user_id][task_index] = task
     
     # Update the button inline FIRST (before answering)
     keyboard = query.message.reply_markup.inline_keyboard
@@ -882,7 +1148,8 @@ async def handle_toggle_action(update: Update, context: ContextTypes.DEFAULT_TYP
     # Update the message inline if button was found
     if button_found:
         try:
-            # Update the button first
+            # Update the button first; the cached full render no longer matches the message
+            _forget_menu(query)
             await query.edit_message_reply_markup(
                 reply_markup=InlineKeyboardMarkup(new_keyboard)
             )
@@ -896,38 +1163,28 @@ async def handle_toggle_action(update: Update, context: ContextTypes.DEFAULT_TYP
             await query.answer(f"{status_text}: {status_display}")
             # Fall back to refreshing the entire menu
             if toggle_type in ["outgoing", "forward_tag", "control"]:
-                await handle_task_menu(update, context)
+                await handle_task_menu(update, context, task_label)
             else:
-                await handle_filter_menu(update, context)
+                await handle_filter_menu(update, context, task_label)
     else:
         # If button not found, at least show notification
         status_display = "✅ On" if new_state else "❌ Off"
         await query.answer(f"{status_text}: {status_display}")
         # Refresh the entire menu
         if toggle_type in ["outgoing", "forward_tag", "control"]:
-            await handle_task_menu(update, context)
+            await handle_task_menu(update, context, task_label)
         else:
-            await handle_filter_menu(update, context)
+            await handle_filter_menu(update, context, task_label)
     
-    # Update database in background
-    try:
-        asyncio.create_task(
-            db_call(db.update_task_filters, user_id, task_label, filters)
-        )
-    except Exception as e:
-        logger.exception("Error updating task filters in DB: %s", e)
+    # Update database in background (debounced)
+    _task_filters_changed(user_id, task_label)
 
 
 async def show_prefix_suffix_menu(query, task_label):
     """Show menu for setting prefix/suffix"""
     user_id = query.from_user.id
     
-    user_tasks = tasks_cache.get(user_id, [])
-    task = None
-    for t in user_tasks:
-        if t["label"] == task_label:
-            task = t
-            break
+    task = tasks_cache.get(user_id, {}).get(task_label)
     
     if not task:
         await query.answer("Task not found!", show_alert=True)
@@ -938,60 +1195,43 @@ async def show_prefix_suffix_menu(query, task_label):
     prefix = filter_settings.get("prefix", "")
     suffix = filter_settings.get("suffix", "")
     
-    message_text = f"🔤 **Prefix/Suffix Setup for: {task_label}**\n\n"
+    message_text = f"🔤 <b>Prefix/Suffix Setup for: {html.escape(task_label)}</b>\n\n"
     message_text += "Add custom text to messages:\n\n"
-    message_text += f"📝 **Current Prefix:** '{prefix}'\n"
-    message_text += f"📝 **Current Suffix:** '{suffix}'\n\n"
-    message_text += "💡 **Examples:**\n"
+    message_text += f"📝 <b>Current Prefix:</b> '{html.escape(prefix)}'\n"
+    message_text += f"📝 <b>Current Suffix:</b> '{html.escape(suffix)}'\n\n"
+    message_text += "💡 <b>Examples:</b>\n"
     message_text += "• Prefix '🔔 ' adds a bell before each message\n"
     message_text += "• Suffix ' ✅' adds a checkmark after\n"
     message_text += "• Use any characters: emojis, signs, numbers, letters\n\n"
-    message_text += "**Tap an option below to set it!**"
+    message_text += "<b>Tap an option below to set it!</b>"
     
     keyboard = [
-        [InlineKeyboardButton("➕ Set Prefix", callback_data=f"prefix_{task_label}_set")],
-        [InlineKeyboardButton("➕ Set Suffix", callback_data=f"suffix_{task_label}_set")],
-        [InlineKeyboardButton("🗑️ Clear Prefix/Suffix", callback_data=f"toggle_{task_label}_clear_prefix_suffix")],
-        [InlineKeyboardButton("🔙 Back to Filters", callback_data=f"filter_{task_label}")]
+        [InlineKeyboardButton("➕ Set Prefix", callback_data=f"prefix|{task_label}")],
+        [InlineKeyboardButton("➕ Set Suffix", callback_data=f"suffix|{task_label}")],
+        [InlineKeyboardButton("🗑️ Clear Prefix/Suffix", callback_data=f"toggle|{task_label}|clear_prefix_suffix")],
+        [InlineKeyboardButton("🔙 Back to Filters", callback_data=f"filter|{task_label}")]
     ]
     
-    await query.edit_message_text(
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
-    )
+    await _edit_menu(query, message_text, keyboard)
 
 
-async def handle_prefix_suffix(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_prefix_suffix(update: Update, context: ContextTypes.DEFAULT_TYPE, task_label: str, action_type: str):
     """Handle prefix/suffix setup"""
     query = update.callback_query
-    user_id = query.from_user.id
-    data_parts = query.data.split("_")
     
-    if len(data_parts) < 3:
-        await query.answer("Invalid action!", show_alert=True)
-        return
-    
-    action_type = data_parts[0]
-    task_label = data_parts[1]
-    action = data_parts[2] if len(data_parts) > 2 else ""
-    
-    if action == "set":
-        context.user_data[f"waiting_{action_type}"] = task_label
-        await query.edit_message_text(
-            f"📝 **Enter the {action_type} text for task '{task_label}':**\n\n"
-            f"Type your {action_type} text now.\n"
-            f"💡 *You can use any characters: emojis 🔔, signs ⚠️, numbers 123, letters ABC*\n\n"
-            f"**Example:** If you want the {action_type} '🔔 ', type: 🔔 ",
-            parse_mode="Markdown"
-        )
-    else:
-        await query.answer(f"Action: {action_type} {action}")
+    context.user_data[f"waiting_{action_type}"] = task_label
+    _forget_menu(query)
+    await query.edit_message_text(
+        f"📝 <b>Enter the {action_type} text for task '{html.escape(task_label)}':</b>\n\n"
+        f"Type your {action_type} text now.\n"
+        f"💡 <i>You can use any characters: emojis 🔔, signs ⚠️, numbers 123, letters ABC</i>\n\n"
+        f"<b>Example:</b> If you want the {action_type} '🔔 ', type: 🔔 ",
+        parse_mode=ParseMode.HTML
+    )
 
 
-async def handle_prefix_suffix_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_prefix_suffix_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     """Handle prefix/suffix text input"""
-    user_id = update.effective_user.id
     text = update.message.text.strip()
     
     waiting_prefix = context.user_data.get("waiting_prefix")
@@ -1008,121 +1248,102 @@ async def handle_prefix_suffix_input(update: Update, context: ContextTypes.DEFAU
     else:
         return
     
-    user_tasks = tasks_cache.get(user_id, [])
-    task_index = -1
-    for i, t in enumerate(user_tasks):
-        if t["label"] == task_label:
-            task_index = i
-            break
-    
-    if task_index == -1:
+    task = tasks_cache.get(user_id, {}).get(task_label)
+    if not task:
         await update.message.reply_text("❌ Task not found!")
         return
     
-    task = user_tasks[task_index]
     filters = task.get("filters", {})
     filter_settings = filters.get("filters", {})
     
     if action_type == "prefix":
         filter_settings["prefix"] = text
-        confirmation = f"✅ **Prefix set to:** '{text}'"
+        confirmation = f"✅ <b>Prefix set to:</b> '{html.escape(text)}'"
     else:
         filter_settings["suffix"] = text
-        confirmation = f"✅ **Suffix set to:** '{text}'"
+        confirmation = f"✅ <b>Suffix set to:</b> '{html.escape(text)}'"
     
     filters["filters"] = filter_settings
     task["filters"] = filters
-    tasks_cache[user_id][task_index] = task
-    
-    try:
-        asyncio.create_task(
-            db_call(db.update_task_filters, user_id, task_label, filters)
-        )
-    except Exception as e:
-        logger.exception("Error updating task filters in DB: %s", e)
+    _task_filters_changed(user_id, task_label)
     
     await update.message.reply_text(
         f"{confirmation}\n\n"
-        f"Task: **{task_label}**\n\n"
+        f"Task: <b>{html.escape(task_label)}</b>\n\n"
         "All messages will now include this text when forwarded!",
-        parse_mode="Markdown"
+        parse_mode=ParseMode.HTML
     )
 
 
-async def handle_delete_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_delete_action(update: Update, context: ContextTypes.DEFAULT_TYPE, task_label: str):
     """Handle task deletion"""
     query = update.callback_query
-    user_id = query.from_user.id
-    task_label = query.data.replace("delete_", "")
     
-    message_text = f"🗑️ **Delete Task: {task_label}**\n\n"
-    message_text += "⚠️ **Are you sure you want to delete this task?**\n\n"
+    message_text = f"🗑️ <b>Delete Task: {html.escape(task_label)}</b>\n\n"
+    message_text += "⚠️ <b>Are you sure you want to delete this task?</b>\n\n"
     message_text += "This action cannot be undone!\n"
     message_text += "All forwarding will stop immediately."
     
     keyboard = [
         [
-            InlineKeyboardButton("✅ Yes, Delete", callback_data=f"confirm_delete_{task_label}"),
-            InlineKeyboardButton("❌ Cancel", callback_data=f"task_{task_label}")
+            InlineKeyboardButton("✅ Yes, Delete", callback_data=f"confirm_delete|{task_label}"),
+            InlineKeyboardButton("❌ Cancel", callback_data=f"task|{task_label}")
         ]
     ]
     
-    await query.edit_message_text(
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
-    )
+    await _edit_menu(query, message_text, keyboard)
 
 
-async def handle_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, task_label: str):
     """Confirm and execute task deletion"""
     query = update.callback_query
     user_id = query.from_user.id
-    task_label = query.data.replace("confirm_delete_", "")
     
     deleted = await db_call(db.remove_forwarding_task, user_id, task_label)
+    _forget_menu(query)
     
     if deleted:
-        if user_id in tasks_cache:
-            tasks_cache[user_id] = [t for t in tasks_cache[user_id] if t.get("label") != task_label]
+        user_tasks = tasks_cache.get(user_id)
+        if user_tasks and user_tasks.pop(task_label, None) is not None:
+            _rebuild_indices(user_id)
         
         await query.edit_message_text(
-            f"✅ **Task '{task_label}' deleted successfully!**\n\n"
+            f"✅ <b>Task '{html.escape(task_label)}' deleted successfully!</b>\n\n"
             "All forwarding for this task has been stopped.",
-            parse_mode="Markdown"
+            parse_mode=ParseMode.HTML
         )
     else:
         await query.edit_message_text(
-            f"❌ **Task '{task_label}' not found!**",
-            parse_mode="Markdown"
+            f"❌ <b>Task '{html.escape(task_label)}' not found!</b>",
+            parse_mode=ParseMode.HTML
         )
 
 
 # ---------- Login/logout commands ----------
 async def login_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
+    user_id = update.effective_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     message = update.message if update.message else update.callback_query.message
 
     if len(user_clients) >= MAX_CONCURRENT_USERS:
         await message.reply_text(
-            "❌ **Server at capacity!**\n\n"
+            "❌ <b>Server at capacity!</b>\n\n"
             "Too many users are currently connected. Please try again later.",
-            parse_mode="Markdown",
+            parse_mode=ParseMode.HTML,
         )
         return
 
     user = await db_call(db.get_user, user_id)
     if user and user.get("is_logged_in"):
         await message.reply_text(
-            "✅ **You are already logged in!**\n\n"
-            f"📱 Phone: `{user['phone']}`\n"
-            f"👤 Name: `{user['name']}`\n\n"
+            "✅ <b>You are already logged in!</b>\n\n"
+            f"📱 Phone: <code>{user['phone']}</code>\n"
+            f"👤 Name: <code>{html.escape(user['name'] or '')}</code>\n\n"
             "Use /logout if you want to disconnect.",
-            parse_mode="Markdown",
+            parse_mode=ParseMode.HTML,
         )
         return
 
@@ -1134,31 +1355,38 @@ async def login_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Telethon connection failed: {e}")
         await message.reply_text(
-            f"❌ **Connection failed:** {str(e)}\n\n"
+            f"❌ <b>Connection failed:</b> {html.escape(str(e))}\n\n"
             "Please try again in a few minutes.",
-            parse_mode="Markdown",
+            parse_mode=ParseMode.HTML,
         )
         return
 
-    login_states[user_id] = {"client": client, "step": "waiting_phone"}
+    previous = login_states.pop(user_id, None)
+    if previous and previous.get("client"):
+        try:
+            await previous["client"].disconnect()
+        except Exception:
+            logger.exception("Error disconnecting previous login client for %s", user_id)
+
+    login_states[user_id] = {"client": client, "step": "waiting_phone", "_ts": time.monotonic()}
 
     await message.reply_text(
-        "📱 **Login Process**\n\n"
-        "1️⃣ **Enter your phone number** (with country code):\n\n"
-        "**Examples:**\n"
-        "• `+1234567890`\n"
-        "• `+447911123456`\n"
-        "• `+4915112345678`\n\n"
-        "⚠️ **Important:**\n"
-        "• Include the `+` sign\n"
+        "📱 <b>Login Process</b>\n\n"
+        "1️⃣ <b>Enter your phone number</b> (with country code):\n\n"
+        "<b>Examples:</b>\n"
+        "• <code>+1234567890</code>\n"
+        "• <code>+447911123456</code>\n"
+        "• <code>+4915112345678</code>\n\n"
+        "⚠️ <b>Important:</b>\n"
+        "• Include the <code>+</code> sign\n"
         "• Use international format\n"
         "• No spaces or dashes\n\n"
         "If you don't receive a code, try:\n"
         "1. Check phone number format\n"
         "2. Wait 2 minutes between attempts\n"
         "3. Use the Telegram app to verify\n\n"
-        "**Type your phone number now:**",
-        parse_mode="Markdown",
+        "<b>Type your phone number now:</b>",
+        parse_mode=ParseMode.HTML,
     )
 
 
@@ -1167,23 +1395,23 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # Check if we're in task creation
     if user_id in task_creation_states:
-        await handle_task_creation(update, context)
+        await handle_task_creation(update, context, user_id)
         return
     
     # Check if we're waiting for prefix/suffix input
     if context.user_data.get("waiting_prefix") or context.user_data.get("waiting_suffix"):
-        await handle_prefix_suffix_input(update, context)
+        await handle_prefix_suffix_input(update, context, user_id)
         return
     
     if user_id in logout_states:
-        handled = await handle_logout_confirmation(update, context)
+        handled = await handle_logout_confirmation(update, context, user_id)
         if handled:
             return
 
-    if user_id not in login_states:
+    state = login_states.get(user_id)
+    if state is None:
         return
 
-    state = login_states[user_id]
     text = update.message.text.strip()
     client = state["client"]
 
@@ -1191,29 +1419,29 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
         if state["step"] == "waiting_phone":
             if not text.startswith('+'):
                 await update.message.reply_text(
-                    "❌ **Invalid format!**\n\n"
-                    "Phone number must start with `+`\n"
-                    "Example: `+1234567890`\n\n"
+                    "❌ <b>Invalid format!</b>\n\n"
+                    "Phone number must start with <code>+</code>\n"
+                    "Example: <code>+1234567890</code>\n\n"
                     "Please enter your phone number again:",
-                    parse_mode="Markdown",
+                    parse_mode=ParseMode.HTML,
                 )
                 return
             
-            clean_phone = ''.join(c for c in text if c.isdigit() or c == '+')
+            clean_phone = _PHONE_JUNK_RE.sub('', text)
             
             if len(clean_phone) < 8:
                 await update.message.reply_text(
-                    "❌ **Invalid phone number!**\n\n"
+                    "❌ <b>Invalid phone number!</b>\n\n"
                     "Phone number seems too short. Please check and try again.\n"
-                    "Example: `+1234567890`",
-                    parse_mode="Markdown",
+                    "Example: <code>+1234567890</code>",
+                    parse_mode=ParseMode.HTML,
                 )
                 return
 
             processing_msg = await update.message.reply_text(
-                "⏳ **Sending verification code...**\n\n"
+                "⏳ <b>Sending verification code...</b>\n\n"
                 "This may take a few seconds. Please wait...",
-                parse_mode="Markdown",
+                parse_mode=ParseMode.HTML,
             )
 
             try:
@@ -1226,20 +1454,20 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
                 state["step"] = "waiting_code"
 
                 await processing_msg.edit_text(
-                    f"✅ **Verification code sent!**\n\n"
-                    f"📱 **Code sent to:** `{clean_phone}`\n\n"
-                    "2️⃣ **Enter the verification code:**\n\n"
-                    "**Format:** `verify12345`\n"
-                    "• Type `verify` followed by your 5-digit code\n"
+                    f"✅ <b>Verification code sent!</b>\n\n"
+                    f"📱 <b>Code sent to:</b> <code>{clean_phone}</code>\n\n"
+                    "2️⃣ <b>Enter the verification code:</b>\n\n"
+                    "<b>Format:</b> <code>verify12345</code>\n"
+                    "• Type <code>verify</code> followed by your 5-digit code\n"
                     "• No spaces, no brackets\n\n"
-                    "**Example:** If your code is `54321`, type:\n"
-                    "`verify54321`\n\n"
-                    "⚠️ **If you don't receive the code:**\n"
+                    "<b>Example:</b> If your code is <code>54321</code>, type:\n"
+                    "<code>verify54321</code>\n\n"
+                    "⚠️ <b>If you don't receive the code:</b>\n"
                     "1. Check your Telegram app notifications\n"
                     "2. Wait 2-3 minutes\n"
                     "3. Check spam messages\n"
                     "4. Try login via Telegram app first",
-                    parse_mode="Markdown",
+                    parse_mode=ParseMode.HTML,
                 )
 
             except Exception as e:
@@ -1247,19 +1475,19 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
                 logger.error(f"Error sending code for user {user_id}: {error_msg}")
                 
                 if "PHONE_NUMBER_INVALID" in error_msg:
-                    error_text = "❌ **Invalid phone number!**\n\nPlease check the format and try again."
+                    error_text = "❌ <b>Invalid phone number!</b>\n\nPlease check the format and try again."
                 elif "PHONE_NUMBER_BANNED" in error_msg:
-                    error_text = "❌ **Phone number banned!**\n\nThis phone number cannot be used."
+                    error_text = "❌ <b>Phone number banned!</b>\n\nThis phone number cannot be used."
                 elif "FLOOD" in error_msg or "Too many" in error_msg:
-                    error_text = "❌ **Too many attempts!**\n\nPlease wait 2-3 minutes before trying again."
+                    error_text = "❌ <b>Too many attempts!</b>\n\nPlease wait 2-3 minutes before trying again."
                 elif "PHONE_CODE_EXPIRED" in error_msg:
-                    error_text = "❌ **Code expired!**\n\nPlease start over with /login."
+                    error_text = "❌ <b>Code expired!</b>\n\nPlease start over with /login."
                 else:
-                    error_text = f"❌ **Error:** {error_msg}\n\nPlease try again in a few minutes."
+                    error_text = f"❌ <b>Error:</b> {html.escape(error_msg)}\n\nPlease try again in a few minutes."
                 
                 await processing_msg.edit_text(
                     error_text + "\n\nUse /login to try again.",
-                    parse_mode="Markdown",
+                    parse_mode=ParseMode.HTML,
                 )
                 
                 try:
@@ -1274,11 +1502,11 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
         elif state["step"] == "waiting_code":
             if not text.startswith("verify"):
                 await update.message.reply_text(
-                    "❌ **Invalid format!**\n\n"
-                    "Please use the format: `verify12345`\n\n"
-                    "Type `verify` followed immediately by your 5-digit code.\n"
-                    "**Example:** `verify54321`",
-                    parse_mode="Markdown",
+                    "❌ <b>Invalid format!</b>\n\n"
+                    "Please use the format: <code>verify12345</code>\n\n"
+                    "Type <code>verify</code> followed immediately by your 5-digit code.\n"
+                    "<b>Example:</b> <code>verify54321</code>",
+                    parse_mode=ParseMode.HTML,
                 )
                 return
 
@@ -1286,25 +1514,25 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
             
             if not code or not code.isdigit():
                 await update.message.reply_text(
-                    "❌ **Invalid code!**\n\n"
+                    "❌ <b>Invalid code!</b>\n\n"
                     "Code must contain only digits.\n"
-                    "**Example:** `verify12345`",
-                    parse_mode="Markdown",
+                    "<b>Example:</b> <code>verify12345</code>",
+                    parse_mode=ParseMode.HTML,
                 )
                 return
             
             if len(code) != 5:
                 await update.message.reply_text(
-                    "❌ **Code must be 5 digits!**\n\n"
+                    "❌ <b>Code must be 5 digits!</b>\n\n"
                     f"Your code has {len(code)} digits. Please check and try again.\n"
-                    "**Example:** `verify12345`",
-                    parse_mode="Markdown",
+                    "<b>Example:</b> <code>verify12345</code>",
+                    parse_mode=ParseMode.HTML,
                 )
                 return
 
             verifying_msg = await update.message.reply_text(
-                "🔄 **Verifying code...**\n\nPlease wait...",
-                parse_mode="Markdown",
+                "🔄 <b>Verifying code...</b>\n\nPlease wait...",
+                parse_mode=ParseMode.HTML,
             )
 
             try:
@@ -1316,62 +1544,63 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
                 await db_call(db.save_user, user_id, state["phone"], me.first_name, session_string, True)
 
                 user_clients[user_id] = client
-                tasks_cache.setdefault(user_id, [])
+                tasks_cache.setdefault(user_id, {})
                 target_entity_cache.setdefault(user_id, {})
                 await start_forwarding_for_user(user_id)
+                await _requeue_pending_sends(user_id)
 
                 del login_states[user_id]
 
                 await verifying_msg.edit_text(
-                    "✅ **Successfully connected!** 🎉\n\n"
-                    f"👤 **Name:** {me.first_name or 'User'}\n"
-                    f"📱 **Phone:** `{state['phone']}`\n"
-                    f"🆔 **User ID:** `{me.id}`\n\n"
-                    "**Now you can:**\n"
+                    "✅ <b>Successfully connected!</b> 🎉\n\n"
+                    f"👤 <b>Name:</b> {html.escape(me.first_name or 'User')}\n"
+                    f"📱 <b>Phone:</b> <code>{state['phone']}</code>\n"
+                    f"🆔 <b>User ID:</b> <code>{me.id}</code>\n\n"
+                    "<b>Now you can:</b>\n"
                     "• Create forwarding tasks with /forwadd\n"
                     "• View your tasks with /fortasks\n"
                     "• Get chat IDs with /getallid\n\n"
                     "Welcome aboard! 🚀",
-                    parse_mode="Markdown",
+                    parse_mode=ParseMode.HTML,
                 )
 
             except SessionPasswordNeededError:
                 state["step"] = "waiting_2fa"
                 await verifying_msg.edit_text(
-                    "🔐 **2-Step Verification Required**\n\n"
+                    "🔐 <b>2-Step Verification Required</b>\n\n"
                     "This account has 2FA enabled for extra security.\n\n"
-                    "3️⃣ **Enter your 2FA password:**\n\n"
-                    "**Format:** `passwordYourPassword123`\n"
-                    "• Type `password` followed by your 2FA password\n"
+                    "3️⃣ <b>Enter your 2FA password:</b>\n\n"
+                    "<b>Format:</b> <code>passwordYourPassword123</code>\n"
+                    "• Type <code>password</code> followed by your 2FA password\n"
                     "• No spaces, no brackets\n\n"
-                    "**Example:** If your password is `mypass123`, type:\n"
-                    "`passwordmypass123`",
-                    parse_mode="Markdown",
+                    "<b>Example:</b> If your password is <code>mypass123</code>, type:\n"
+                    "<code>passwordmypass123</code>",
+                    parse_mode=ParseMode.HTML,
                 )
             except Exception as e:
                 error_msg = str(e)
                 logger.error(f"Error verifying code for user {user_id}: {error_msg}")
                 
                 if "PHONE_CODE_INVALID" in error_msg:
-                    error_text = "❌ **Invalid code!**\n\nPlease check the code and try again."
+                    error_text = "❌ <b>Invalid code!</b>\n\nPlease check the code and try again."
                 elif "PHONE_CODE_EXPIRED" in error_msg:
-                    error_text = "❌ **Code expired!**\n\nPlease request a new code with /login."
+                    error_text = "❌ <b>Code expired!</b>\n\nPlease request a new code with /login."
                 else:
-                    error_text = f"❌ **Verification failed:** {error_msg}"
+                    error_text = f"❌ <b>Verification failed:</b> {html.escape(error_msg)}"
                 
                 await verifying_msg.edit_text(
                     error_text + "\n\nUse /login to try again.",
-                    parse_mode="Markdown",
+                    parse_mode=ParseMode.HTML,
                 )
 
         elif state["step"] == "waiting_2fa":
             if not text.startswith("password"):
                 await update.message.reply_text(
-                    "❌ **Invalid format!**\n\n"
-                    "Please use the format: `passwordYourPassword123`\n\n"
-                    "Type `password` followed immediately by your 2FA password.\n"
-                    "**Example:** `passwordmypass123`",
-                    parse_mode="Markdown",
+                    "❌ <b>Invalid format!</b>\n\n"
+                    "Please use the format: <code>passwordYourPassword123</code>\n\n"
+                    "Type <code>password</code> followed immediately by your 2FA password.\n"
+                    "<b>Example:</b> <code>passwordmypass123</code>",
+                    parse_mode=ParseMode.HTML,
                 )
                 return
 
@@ -1379,16 +1608,16 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
 
             if not password:
                 await update.message.reply_text(
-                    "❌ **No password provided!**\n\n"
-                    "Please type `password` followed by your 2FA password.\n"
-                    "**Example:** `passwordmypass123`",
-                    parse_mode="Markdown",
+                    "❌ <b>No password provided!</b>\n\n"
+                    "Please type <code>password</code> followed by your 2FA password.\n"
+                    "<b>Example:</b> <code>passwordmypass123</code>",
+                    parse_mode=ParseMode.HTML,
                 )
                 return
 
             verifying_msg = await update.message.reply_text(
-                "🔄 **Verifying 2FA password...**\n\nPlease wait...",
-                parse_mode="Markdown",
+                "🔄 <b>Verifying 2FA password...</b>\n\nPlease wait...",
+                parse_mode=ParseMode.HTML,
             )
 
             try:
@@ -1400,23 +1629,24 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
                 await db_call(db.save_user, user_id, state["phone"], me.first_name, session_string, True)
 
                 user_clients[user_id] = client
-                tasks_cache.setdefault(user_id, [])
+                tasks_cache.setdefault(user_id, {})
                 target_entity_cache.setdefault(user_id, {})
                 await start_forwarding_for_user(user_id)
+                await _requeue_pending_sends(user_id)
 
                 del login_states[user_id]
 
                 await verifying_msg.edit_text(
-                    "✅ **Successfully connected with 2FA!** 🎉\n\n"
-                    f"👤 **Name:** {me.first_name or 'User'}\n"
-                    f"📱 **Phone:** `{state['phone']}`\n"
-                    f"🆔 **User ID:** `{me.id}`\n\n"
-                    "**Now you can:**\n"
+                    "✅ <b>Successfully connected with 2FA!</b> 🎉\n\n"
+                    f"👤 <b>Name:</b> {html.escape(me.first_name or 'User')}\n"
+                    f"📱 <b>Phone:</b> <code>{state['phone']}</code>\n"
+                    f"🆔 <b>User ID:</b> <code>{me.id}</code>\n\n"
+                    "<b>Now you can:</b>\n"
                     "• Create forwarding tasks with /forwadd\n"
                     "• View your tasks with /fortasks\n"
                     "• Get chat IDs with /getallid\n\n"
                     "Your account is now securely connected! 🔐",
-                    parse_mode="Markdown",
+                    parse_mode=ParseMode.HTML,
                 )
 
             except Exception as e:
@@ -1424,22 +1654,22 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
                 logger.error(f"Error verifying 2FA for user {user_id}: {error_msg}")
                 
                 if "PASSWORD_HASH_INVALID" in error_msg or "PASSWORD_INVALID" in error_msg:
-                    error_text = "❌ **Invalid 2FA password!**\n\nPlease check your password and try again."
+                    error_text = "❌ <b>Invalid 2FA password!</b>\n\nPlease check your password and try again."
                 else:
-                    error_text = f"❌ **2FA verification failed:** {error_msg}"
+                    error_text = f"❌ <b>2FA verification failed:</b> {html.escape(error_msg)}"
                 
                 await verifying_msg.edit_text(
                     error_text + "\n\nUse /login to try again.",
-                    parse_mode="Markdown",
+                    parse_mode=ParseMode.HTML,
                 )
 
     except Exception as e:
         logger.exception("Unexpected error during login process for %s", user_id)
         await update.message.reply_text(
-            f"❌ **Unexpected error:** {str(e)}\n\n"
+            f"❌ <b>Unexpected error:</b> {html.escape(str(e))}\n\n"
             "Please try /login again.\n\n"
             "If the problem persists, contact support.",
-            parse_mode="Markdown",
+            parse_mode=ParseMode.HTML,
         )
         if user_id in login_states:
             try:
@@ -1452,9 +1682,9 @@ async def handle_login_process(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
+    user_id = update.effective_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     message = update.message if update.message else update.callback_query.message
@@ -1462,23 +1692,22 @@ async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = await db_call(db.get_user, user_id)
     if not user or not user["is_logged_in"]:
         await message.reply_text(
-            "❌ **You're not connected!**\n\n" "Use /login to connect your account.", parse_mode="Markdown"
+            "❌ <b>You're not connected!</b>\n\n" "Use /login to connect your account.", parse_mode=ParseMode.HTML
         )
         return
 
-    logout_states[user_id] = {"phone": user["phone"]}
+    logout_states[user_id] = {"phone": user["phone"], "_ts": time.monotonic()}
 
     await message.reply_text(
-        "⚠️ **Confirm Logout**\n\n"
-        f"📱 **Enter your phone number to confirm disconnection:**\n\n"
-        f"Your connected phone: `{user['phone']}`\n\n"
+        "⚠️ <b>Confirm Logout</b>\n\n"
+        f"📱 <b>Enter your phone number to confirm disconnection:</b>\n\n"
+        f"Your connected phone: <code>{user['phone']}</code>\n\n"
         "Type your phone number exactly to confirm logout.",
-        parse_mode="Markdown",
+        parse_mode=ParseMode.HTML,
     )
 
 
-async def handle_logout_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    user_id = update.effective_user.id
+async def handle_logout_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
 
     if user_id not in logout_states:
         return False
@@ -1488,11 +1717,11 @@ async def handle_logout_confirmation(update: Update, context: ContextTypes.DEFAU
 
     if text != stored_phone:
         await update.message.reply_text(
-            "❌ **Phone number doesn't match!**\n\n"
-            f"Expected: `{stored_phone}`\n"
-            f"You entered: `{text}`\n\n"
+            "❌ <b>Phone number doesn't match!</b>\n\n"
+            f"Expected: <code>{stored_phone}</code>\n"
+            f"You entered: <code>{html.escape(text)}</code>\n\n"
             "Please try again or use /start to cancel.",
-            parse_mode="Markdown",
+            parse_mode=ParseMode.HTML,
         )
         return True
 
@@ -1517,16 +1746,29 @@ async def handle_logout_confirmation(update: Update, context: ContextTypes.DEFAU
         await db_call(db.save_user, user_id, None, None, None, False)
     except Exception:
         logger.exception("Error saving user logout state for %s", user_id)
+    try:
+        await db_call(db.clear_target_peers, user_id)
+    except Exception:
+        logger.exception("Error clearing stored target peers for %s", user_id)
+    try:
+        await db_call(db.clear_pending_sends, user_id)
+    except Exception:
+        logger.exception("Error clearing pending sends for %s", user_id)
     
     tasks_cache.pop(user_id, None)
+    source_index.pop(user_id, None)
+    task_counts.pop(user_id, None)
+    _dialogs_cache.pop(user_id, None)
     target_entity_cache.pop(user_id, None)
+    _user_send_slots.pop(user_id, None)
+    _flood_until.pop(user_id, None)
     logout_states.pop(user_id, None)
 
     await update.message.reply_text(
-        "👋 **Account disconnected successfully!**\n\n"
+        "👋 <b>Account disconnected successfully!</b>\n\n"
         "✅ All your forwarding tasks have been stopped.\n"
         "🔄 Use /login to connect again.",
-        parse_mode="Markdown",
+        parse_mode=ParseMode.HTML,
     )
     return True
 
@@ -1534,15 +1776,15 @@ async def handle_logout_confirmation(update: Update, context: ContextTypes.DEFAU
 async def getallid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     user = await db_call(db.get_user, user_id)
     if not user or not user["is_logged_in"]:
-        await update.message.reply_text("❌ **You need to connect your account first!**\n\n" "Use /login to connect.", parse_mode="Markdown")
+        await update.message.reply_text("❌ <b>You need to connect your account first!</b>\n\n" "Use /login to connect.", parse_mode=ParseMode.HTML)
         return
 
-    await update.message.reply_text("🔄 **Fetching your chats...**")
+    await update.message.reply_text("🔄 <b>Fetching your chats...</b>", parse_mode=ParseMode.HTML)
 
     await show_chat_categories(user_id, update.message.chat.id, None, context)
 
@@ -1552,12 +1794,12 @@ async def adduser_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin-only: add a user (optionally as admin)."""
     user_id = update.effective_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     is_admin_caller = await db_call(db.is_user_admin, user_id)
     if not is_admin_caller:
-        await update.message.reply_text("❌ **Admin Only**\n\nThis command is only available to admins.", parse_mode="Markdown")
+        await update.message.reply_text("❌ <b>Admin Only</b>\n\nThis command is only available to admins.", parse_mode=ParseMode.HTML)
         return
 
     text = update.message.text.strip()
@@ -1565,11 +1807,11 @@ async def adduser_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if len(parts) < 2:
         await update.message.reply_text(
-            "❌ **Invalid format!**\n\n"
-            "**Usage:**\n"
+            "❌ <b>Invalid format!</b>\n\n"
+            "<b>Usage:</b>\n"
             "/adduser [USER_ID] - Add regular user\n"
             "/adduser [USER_ID] admin - Add admin user",
-            parse_mode="Markdown",
+            parse_mode=ParseMode.HTML,
         )
         return
 
@@ -1578,45 +1820,47 @@ async def adduser_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_admin = len(parts) > 2 and parts[2].lower() == "admin"
 
         added = await db_call(db.add_allowed_user, new_user_id, None, is_admin, user_id)
+        invalidate_auth_cache(new_user_id)
         if added:
             role = "👑 Admin" if is_admin else "👤 User"
             await update.message.reply_text(
-                f"✅ **User added!**\n\nID: `{new_user_id}`\nRole: {role}",
-                parse_mode="Markdown",
+                f"✅ <b>User added!</b>\n\nID: <code>{new_user_id}</code>\nRole: {role}",
+                parse_mode=ParseMode.HTML,
             )
             try:
-                await context.bot.send_message(new_user_id, "✅ You have been added. Send /start to begin.", parse_mode="Markdown")
+                await context.bot.send_message(new_user_id, "✅ You have been added. Send /start to begin.", parse_mode=ParseMode.HTML)
             except Exception:
                 logger.exception("Could not notify new allowed user %s", new_user_id)
         else:
-            await update.message.reply_text(f"❌ **User `{new_user_id}` already exists!**", parse_mode="Markdown")
+            await update.message.reply_text(f"❌ <b>User <code>{new_user_id}</code> already exists!</b>", parse_mode=ParseMode.HTML)
     except ValueError:
-        await update.message.reply_text("❌ **Invalid user ID!**\n\nUser ID must be a number.", parse_mode="Markdown")
+        await update.message.reply_text("❌ <b>Invalid user ID!</b>\n\nUser ID must be a number.", parse_mode=ParseMode.HTML)
 
 
 async def removeuser_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin-only: remove a user and stop their forwarding permanently in this process."""
     user_id = update.effective_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     is_admin_caller = await db_call(db.is_user_admin, user_id)
     if not is_admin_caller:
-        await update.message.reply_text("❌ **Admin Only**\n\nThis command is only available to admins.", parse_mode="Markdown")
+        await update.message.reply_text("❌ <b>Admin Only</b>\n\nThis command is only available to admins.", parse_mode=ParseMode.HTML)
         return
 
     text = update.message.text.strip()
     parts = text.split()
 
     if len(parts) < 2:
-        await update.message.reply_text("❌ **Invalid format!**\n\n**Usage:** `/removeuser [USER_ID]`", parse_mode="Markdown")
+        await update.message.reply_text("❌ <b>Invalid format!</b>\n\n<b>Usage:</b> <code>/removeuser [USER_ID]</code>", parse_mode=ParseMode.HTML)
         return
 
     try:
         remove_user_id = int(parts[1])
 
         removed = await db_call(db.remove_allowed_user, remove_user_id)
+        invalidate_auth_cache(remove_user_id)
         if removed:
             if remove_user_id in user_clients:
                 try:
@@ -1639,42 +1883,55 @@ async def removeuser_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 await db_call(db.save_user, remove_user_id, None, None, None, False)
             except Exception:
                 logger.exception("Error saving user logged_out state for %s", remove_user_id)
+            try:
+                await db_call(db.clear_target_peers, remove_user_id)
+            except Exception:
+                logger.exception("Error clearing stored target peers for %s", remove_user_id)
+            try:
+                await db_call(db.clear_pending_sends, remove_user_id)
+            except Exception:
+                logger.exception("Error clearing pending sends for %s", remove_user_id)
 
             tasks_cache.pop(remove_user_id, None)
+            source_index.pop(remove_user_id, None)
+            task_counts.pop(remove_user_id, None)
+            _dialogs_cache.pop(remove_user_id, None)
             target_entity_cache.pop(remove_user_id, None)
+            _user_send_slots.pop(remove_user_id, None)
+            _flood_until.pop(remove_user_id, None)
             handler_registered.pop(remove_user_id, None)
 
-            await update.message.reply_text(f"✅ **User `{remove_user_id}` removed!**", parse_mode="Markdown")
+            await update.message.reply_text(f"✅ <b>User <code>{remove_user_id}</code> removed!</b>", parse_mode=ParseMode.HTML)
 
             try:
-                await context.bot.send_message(remove_user_id, "❌ You have been removed. Contact the owner to regain access.", parse_mode="Markdown")
+                await context.bot.send_message(remove_user_id, "❌ You have been removed. Contact the owner to regain access.", parse_mode=ParseMode.HTML)
             except Exception:
                 logger.exception("Could not notify removed user %s", remove_user_id)
         else:
-            await update.message.reply_text(f"❌ **User `{remove_user_id}` not found!**", parse_mode="Markdown")
+            await update.message.reply_text(f"❌ <b>User <code>{remove_user_id}</code> not found!</b>", parse_mode=ParseMode.HTML)
     except ValueError:
-        await update.message.reply_text("❌ **Invalid user ID!**\n\nUser ID must be a number.", parse_mode="Markdown")
+        await update.message.reply_text("❌ <b>Invalid user ID!</b>\n\nUser ID must be a number.", parse_mode=ParseMode.HTML)
 
 
 async def listusers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin-only: list allowed users."""
     user_id = update.effective_user.id
 
-    if not await check_authorization(update, context):
+    if not await check_authorization(update, context, user_id):
         return
 
     is_admin_caller = await db_call(db.is_user_admin, user_id)
     if not is_admin_caller:
-        await update.message.reply_text("❌ **Admin Only**\n\nThis command is only available to admins.", parse_mode="Markdown")
+        await update.message.reply_text("❌ <b>Admin Only</b>\n\nThis command is only available to admins.", parse_mode=ParseMode.HTML)
         return
 
     users = await db_call(db.get_all_allowed_users)
 
     if not users:
-        await update.message.reply_text("📋 **No Allowed Users**\n\nThe allowed users list is empty.", parse_mode="Markdown")
+        await update.message.reply_text("📋 <b>No Allowed Users</b>\n\nThe allowed users list is empty.", parse_mode=ParseMode.HTML)
         return
 
-    user_list = "👥 **Allowed Users**\n\n"
+    user_list = "👥 <b>Allowed Users</b>\n\n"
     user_list += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
 
     for i, user in enumerate(users, 1):
@@ -1682,16 +1939,16 @@ async def listusers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         role_text = "Admin" if user["is_admin"] else "User"
         username = user["username"] if user["username"] else "Unknown"
 
-        user_list += f"{i}. {role_emoji} **{role_text}**\n"
-        user_list += f"   ID: `{user['user_id']}`\n"
+        user_list += f"{i}. {role_emoji} <b>{role_text}</b>\n"
+        user_list += f"   ID: <code>{user['user_id']}</code>\n"
         if user["username"]:
-            user_list += f"   Username: {username}\n"
+            user_list += f"   Username: {html.escape(username)}\n"
         user_list += "\n"
 
     user_list += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-    user_list += f"Total: **{len(users)} user(s)**"
+    user_list += f"Total: <b>{len(users)} user(s)</b>"
 
-    await update.message.reply_text(user_list, parse_mode="Markdown")
+    await update.message.reply_text(user_list, parse_mode=ParseMode.HTML)
 
 
 # ---------- Chat listing functions ----------
@@ -1700,57 +1957,83 @@ async def show_chat_categories(user_id: int, chat_id: int, message_id: int, cont
         return
 
     message_text = (
-        "🗂️ **Chat ID Categories**\n\n"
+        "🗂️ <b>Chat ID Categories</b>\n\n"
         "📋 Choose which type of chat IDs you want to see:\n\n"
         "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        "🤖 **Bots** - Bot accounts\n"
-        "📢 **Channels** - Broadcast channels\n"
-        "👥 **Groups** - Group chats\n"
-        "👤 **Private** - Private conversations\n\n"
+        "🤖 <b>Bots</b> - Bot accounts\n"
+        "📢 <b>Channels</b> - Broadcast channels\n"
+        "👥 <b>Groups</b> - Group chats\n"
+        "👤 <b>Private</b> - Private conversations\n\n"
         "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
         "💡 Select a category below:"
     )
 
     keyboard = [
-        [InlineKeyboardButton("🤖 Bots", callback_data="chatids_bots_0"), InlineKeyboardButton("📢 Channels", callback_data="chatids_channels_0")],
-        [InlineKeyboardButton("👥 Groups", callback_data="chatids_groups_0"), InlineKeyboardButton("👤 Private", callback_data="chatids_private_0")],
+        [InlineKeyboardButton("🤖 Bots", callback_data="chatids|bots|0"), InlineKeyboardButton("📢 Channels", callback_data="chatids|channels|0")],
+        [InlineKeyboardButton("👥 Groups", callback_data="chatids|groups|0"), InlineKeyboardButton("👤 Private", callback_data="chatids|private|0")],
     ]
 
     if message_id:
-        await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=message_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=message_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
     else:
-        await context.bot.send_message(chat_id=chat_id, text=message_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await context.bot.send_message(chat_id=chat_id, text=message_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+
+
+def _dialog_in_category(entity, category: str) -> bool:
+    if category == "bots":
+        return isinstance(entity, User) and entity.bot
+    if category == "channels":
+        return isinstance(entity, Channel) and getattr(entity, "broadcast", False)
+    if category == "groups":
+        return isinstance(entity, (Channel, Chat)) and not (isinstance(entity, Channel) and getattr(entity, "broadcast", False))
+    if category == "private":
+        return isinstance(entity, User) and not entity.bot
+    return False
+
+
+async def _get_category_dialogs(user_id: int, client: TelegramClient, category: str, needed: int) -> Tuple[List[Any], bool]:
+    """Return up to `needed` dialogs in category and whether that is all of them, reusing a recent fetch"""
+    cached = _dialogs_cache.get(user_id)
+    if cached and time.monotonic() - cached[0] <= DIALOG_CACHE_TTL:
+        _, dialogs, complete = cached
+        matches = []
+        for dialog in dialogs:
+            if _dialog_in_category(dialog.entity, category):
+                matches.append(dialog)
+                if len(matches) >= needed:
+                    return matches, False
+        if complete:
+            return matches, True
+
+    # Nothing cached (or the cached prefix is too short): fetch, stopping once the page is filled
+    dialogs = []
+    matches = []
+    complete = True
+    async for dialog in client.iter_dialogs():
+        dialogs.append(dialog)
+        if _dialog_in_category(dialog.entity, category):
+            matches.append(dialog)
+            if len(matches) >= needed:
+                complete = False
+                break
+    _dialogs_cache[user_id] = (time.monotonic(), dialogs, complete)
+    return matches, complete
 
 
 async def show_categorized_chats(user_id: int, chat_id: int, message_id: int, category: str, page: int, context: ContextTypes.DEFAULT_TYPE):
-    from telethon.tl.types import User, Channel, Chat
-
     if user_id not in user_clients:
         return
 
     client = user_clients[user_id]
 
-    categorized_dialogs = []
-    async for dialog in client.iter_dialogs():
-        entity = dialog.entity
-
-        if category == "bots":
-            if isinstance(entity, User) and entity.bot:
-                categorized_dialogs.append(dialog)
-        elif category == "channels":
-            if isinstance(entity, Channel) and getattr(entity, "broadcast", False):
-                categorized_dialogs.append(dialog)
-        elif category == "groups":
-            if isinstance(entity, (Channel, Chat)) and not (isinstance(entity, Channel) and getattr(entity, "broadcast", False)):
-                categorized_dialogs.append(dialog)
-        elif category == "private":
-            if isinstance(entity, User) and not entity.bot:
-                categorized_dialogs.append(dialog)
-
     PAGE_SIZE = 10
-    total_pages = max(1, (len(categorized_dialogs) + PAGE_SIZE - 1) // PAGE_SIZE)
     start = page * PAGE_SIZE
     end = start + PAGE_SIZE
+    # One match past this page is enough to know whether a Next button is needed
+    categorized_dialogs, exhausted = await _get_category_dialogs(user_id, client, category, end + 1)
+
+    has_next = len(categorized_dialogs) > end
+    total_pages = max(1, (len(categorized_dialogs) + PAGE_SIZE - 1) // PAGE_SIZE)
     page_dialogs = categorized_dialogs[start:end]
 
     category_emoji = {"bots": "🤖", "channels": "📢", "groups": "👥", "private": "👤"}
@@ -1760,36 +2043,40 @@ async def show_categorized_chats(user_id: int, chat_id: int, message_id: int, ca
     name = category_name.get(category, "Chats")
 
     if not categorized_dialogs:
-        chat_list = f"{emoji} **{name}**\n\n"
-        chat_list += f"📭 **No {name.lower()} found!**\n\n"
+        chat_list = f"{emoji} <b>{name}</b>\n\n"
+        chat_list += f"📭 <b>No {name.lower()} found!</b>\n\n"
         chat_list += "Try another category."
     else:
-        chat_list = f"{emoji} **{name}** (Page {page + 1}/{total_pages})\n\n"
+        page_label = f"{page + 1}/{total_pages}" if exhausted else f"{page + 1}"
+        chat_list = f"{emoji} <b>{name}</b> (Page {page_label})\n\n"
         chat_list += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
 
         for i, dialog in enumerate(page_dialogs, start + 1):
             chat_name = dialog.name[:30] if dialog.name else "Unknown"
-            chat_list += f"{i}. **{chat_name}**\n"
-            chat_list += f"   🆔 `{dialog.id}`\n\n"
+            chat_list += f"{i}. <b>{html.escape(chat_name)}</b>\n"
+            chat_list += f"   🆔 <code>{dialog.id}</code>\n\n"
 
         chat_list += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        chat_list += f"📊 Total: {len(categorized_dialogs)} {name.lower()}\n"
+        if exhausted:
+            chat_list += f"📊 Total: {len(categorized_dialogs)} {name.lower()}\n"
+        else:
+            chat_list += f"📊 Showing {start + 1}-{start + len(page_dialogs)} {name.lower()}\n"
         chat_list += "💡 Tap to copy the ID!"
 
     keyboard = []
 
     nav_row = []
     if page > 0:
-        nav_row.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"chatids_{category}_{page - 1}"))
-    if page < total_pages - 1:
-        nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"chatids_{category}_{page + 1}"))
+        nav_row.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"chatids|{category}|{page - 1}"))
+    if has_next:
+        nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"chatids|{category}|{page + 1}"))
 
     if nav_row:
         keyboard.append(nav_row)
 
-    keyboard.append([InlineKeyboardButton("🔙 Back to Categories", callback_data="chatids_back")])
+    keyboard.append([InlineKeyboardButton("🔙 Back to Categories", callback_data="chatids|back")])
 
-    await context.bot.edit_message_text(chat_list, chat_id=chat_id, message_id=message_id, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await context.bot.edit_message_text(chat_list, chat_id=chat_id, message_id=message_id, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
 
 
 # ---------- OPTIMIZED Forwarding core ----------
@@ -1799,54 +2086,62 @@ def ensure_handler_registered_for_user(user_id: int, client: TelegramClient):
         return
 
     async def _hot_message_handler(event):
-        try:
-            await optimized_gc()
-            
-            message = getattr(event, "message", None)
-            if not message:
-                return
-                
-            message_text = getattr(event, "raw_text", None) or getattr(message, "message", None)
-            if not message_text:
-                return
+        # NewMessage events always carry a Message; read its fields directly
+        message = event.message
+        message_text = message.message
+        if not message_text:
+            return
 
-            chat_id = getattr(event, "chat_id", None) or getattr(message, "chat_id", None)
-            if chat_id is None:
-                return
+        chat_id = message.chat_id
+        if chat_id is None:
+            return
 
-            user_tasks = tasks_cache.get(user_id)
-            if not user_tasks:
-                return
+        # Only the tasks reading this chat; the tuple is a snapshot safe against concurrent edits
+        matched = source_index.get(user_id, {}).get(chat_id)
+        if not matched:
+            return
 
-            message_outgoing = getattr(message, "out", False)
+        message_outgoing = message.out
+        # Resolved targets are looked up once per message and travel with each job
+        resolved_targets = target_entity_cache.get(user_id, {})
+        # Source chat peer for tagged forwards, resolved at most once per message for all tasks/targets
+        source_peer = None
+        
+        for task in matched:
+            # Every cached task carries its filters dict; bind it once per task
+            task_filters = task["filters"]
+            if not task_filters.get("control", True):
+                continue
+                
+            if message_outgoing and not task_filters.get("outgoing", True):
+                continue
+                
+            forward_tag = task_filters.get("forward_tag", False)
+            if forward_tag and source_peer is None:
+                try:
+                    source_peer = await event.get_input_chat()
+                except Exception:
+                    logger.warning("Could not resolve source chat %s for user %s", chat_id, user_id)
+            try:
+                filtered_messages = task["plan"](message_text)
+            except Exception:
+                # One misconfigured task must not stop delivery for the others
+                logger.exception("Error filtering message for user %s task %s", user_id, task.get("label"))
+                continue
             
-            for task in user_tasks:
-                if not task.get("filters", {}).get("control", True):
-                    continue
-                    
-                if message_outgoing and not task.get("filters", {}).get("outgoing", True):
-                    continue
-                    
-                if chat_id in task.get("source_ids", []):
-                    forward_tag = task.get("filters", {}).get("forward_tag", False)
-                    filtered_messages = apply_filters(message_text, task.get("filters", {}))
-                    
-                    for filtered_msg in filtered_messages:
-                        for target_id in task.get("target_ids", []):
-                            try:
-                                global send_queue
-                                if send_queue is None:
-                                    logger.debug("Send queue not initialized; dropping forward job")
-                                    continue
-                                    
-                                await send_queue.put((user_id, client, int(target_id), filtered_msg, 
-                                                     task.get("filters", {}), forward_tag, 
-                                                     chat_id if forward_tag else None,
-                                                     message.id if forward_tag else None))
-                            except asyncio.QueueFull:
-                                logger.warning("Send queue full, dropping forward job for user=%s target=%s", user_id, target_id)
-        except Exception:
-            logger.exception("Error in hot message handler for user %s", user_id)
+            for filtered_msg in filtered_messages:
+                # Parse once here rather than once per target inside send_message
+                send_text, send_entities = _parse_outgoing_text(filtered_msg)
+                for target_id in task.get("target_ids", []):
+                    try:
+                        _enqueue_send((user_id, client, int(target_id), send_text, 
+                                             task_filters, forward_tag, 
+                                             source_peer if forward_tag else None,
+                                             message.id if forward_tag else None,
+                                             resolved_targets.get(target_id),
+                                             send_entities))
+                    except asyncio.QueueFull:
+                        logger.warning("Send queue full, dropping forward job for user=%s target=%s", user_id, target_id)
 
     try:
         client.add_event_handler(_hot_message_handler, events.NewMessage())
@@ -1856,89 +2151,279 @@ def ensure_handler_registered_for_user(user_id: int, client: TelegramClient):
         logger.exception("Failed to add event handler for user %s", user_id)
 
 
+def _peer_to_row(entity: object) -> Optional[Tuple[str, int, int]]:
+    """Flatten a resolved InputPeer into (peer_type, peer_id, access_hash) for storage"""
+    if isinstance(entity, InputPeerChannel):
+        return "channel", entity.channel_id, entity.access_hash
+    if isinstance(entity, InputPeerUser):
+        return "user", entity.user_id, entity.access_hash
+    if isinstance(entity, InputPeerChat):
+        return "chat", entity.chat_id, 0
+    return None
+
+
+def _peer_from_row(row: Dict) -> Optional[object]:
+    peer_type = row.get("peer_type")
+    if peer_type == "channel":
+        return InputPeerChannel(row["peer_id"], row["access_hash"])
+    if peer_type == "user":
+        return InputPeerUser(row["peer_id"], row["access_hash"])
+    if peer_type == "chat":
+        return InputPeerChat(row["peer_id"])
+    return None
+
+
+async def _persist_target_peer(user_id: int, target_id: int, entity: object):
+    row = _peer_to_row(entity)
+    if row is None:
+        return
+    try:
+        await db_call(db.save_target_peer, user_id, target_id, *row)
+    except Exception:
+        logger.exception("Error persisting resolved target %s for user %s", target_id, user_id)
+
+
+async def _load_stored_target_peers(user_id: int, target_ids: List[int]) -> List[int]:
+    """Seed target_entity_cache from stored peers; returns the targets that still need resolving"""
+    cache = target_entity_cache.setdefault(user_id, {})
+    try:
+        stored = await db_call(db.get_target_peers, user_id)
+    except Exception:
+        logger.exception("Error loading stored target peers for %s", user_id)
+        stored = {}
+    missing = []
+    for tid in target_ids:
+        if tid in cache:
+            continue
+        entity = _peer_from_row(stored[tid]) if tid in stored else None
+        if entity is None:
+            missing.append(tid)
+        else:
+            cache[tid] = entity
+    return missing
+
+
 async def resolve_target_entity_once(user_id: int, client: TelegramClient, target_id: int) -> Optional[object]:
-    """Try to resolve a target entity and cache it."""
+    """Try to resolve a target entity and cache it; concurrent callers share one lookup."""
     if user_id not in target_entity_cache:
         target_entity_cache[user_id] = {}
 
     if target_id in target_entity_cache[user_id]:
         return target_entity_cache[user_id][target_id]
 
+    key = (user_id, target_id)
+    inflight = _inflight_resolves.get(key)
+    if inflight is not None:
+        # shield: a cancelled waiter must not cancel the lookup other callers are awaiting
+        return await asyncio.shield(inflight)
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight_resolves[key] = fut
+    entity = None
     try:
         entity = await client.get_input_entity(int(target_id))
-        target_entity_cache[user_id][target_id] = entity
-        return entity
+        target_entity_cache.setdefault(user_id, {})[target_id] = entity
     except Exception:
         logger.debug("Could not resolve target %s for user %s now", target_id, user_id)
-        return None
+    finally:
+        _inflight_resolves.pop(key, None)
+        if not fut.done():
+            fut.set_result(entity)
+    if entity is not None:
+        _spawn_write(_persist_target_peer(user_id, target_id, entity))
+    return entity
 
 
-async def resolve_targets_for_user(user_id: int, target_ids: List[int]):
+async def resolve_targets_for_user(user_id: int, target_ids: Iterable[int]):
     """Background resolver that attempts to resolve targets for a user."""
     client = user_clients.get(user_id)
     if not client:
         return
-    for tid in target_ids:
-        for attempt in range(3):
-            ent = await resolve_target_entity_once(user_id, client, tid)
-            if ent:
-                logger.info("Resolved target %s for user %s", tid, user_id)
-                break
-            await asyncio.sleep(TARGET_RESOLVE_RETRY_SECONDS)
+    target_ids = await _load_stored_target_peers(user_id, list(dict.fromkeys(target_ids)))
+    if len(target_ids) > 1:
+        target_ids = await _resolve_targets_from_dialogs(user_id, client, target_ids)
+    await asyncio.gather(*(_resolve_target_with_retries(user_id, client, tid) for tid in target_ids))
+
+
+async def _resolve_targets_from_dialogs(user_id: int, client: TelegramClient, target_ids: List[int]) -> List[int]:
+    """Resolve several targets from one dialog sweep; returns the ones not found there"""
+    pending = set(target_ids)
+    cache = target_entity_cache.setdefault(user_id, {})
+    try:
+        async with _resolve_slots:
+            async for dialog in client.iter_dialogs():
+                if dialog.id not in pending:
+                    continue
+                entity = dialog.input_entity
+                cache[dialog.id] = entity
+                _spawn_write(_persist_target_peer(user_id, dialog.id, entity))
+                pending.discard(dialog.id)
+                if not pending:
+                    break
+    except Exception:
+        logger.debug("Dialog sweep for targets failed for user %s", user_id)
+    return [tid for tid in target_ids if tid in pending]
+
+
+async def _resolve_target_with_retries(user_id: int, client: TelegramClient, target_id: int):
+    for attempt in range(3):
+        async with _resolve_slots:
+            ent = await resolve_target_entity_once(user_id, client, target_id)
+        if ent:
+            logger.info("Resolved target %s for user %s", target_id, user_id)
+            return
+        await asyncio.sleep(TARGET_RESOLVE_RETRY_SECONDS)
+
+
+# Same pattern TelegramClient._parse_message_text uses to spot links it turns into user mentions
+_MENTION_URL_RE = re.compile(r'^@|\+|tg://user\?id=(\d+)')
+
+
+def _parse_outgoing_text(text: str) -> Tuple[str, Optional[List[Any]]]:
+    """Pre-parse markdown once for all targets; entities is None when send_message must parse it itself.
+
+    Mirrors the client-independent part of send_message's parsing (empty-result check, zero-length
+    entities). Mention links need a per-client user lookup, so those messages go through unparsed.
+    """
+    try:
+        parsed_text, entities = markdown.parse(text)
+    except Exception:
+        return text, None
+    if text and not parsed_text and not entities:
+        # send_message raises "Failed to parse message" for this; keep that behaviour
+        return text, None
+    kept = []
+    for e in entities:
+        if not e.length:
+            continue
+        if isinstance(e, (MessageEntityMentionName, InputMessageEntityMentionName)):
+            return text, None
+        if isinstance(e, MessageEntityTextUrl) and _MENTION_URL_RE.match(e.url):
+            return text, None
+        kept.append(e)
+    return parsed_text, kept
+
+
+async def _send_one(job: Tuple) -> Optional[int]:
+    """Deliver one send job; returns the FloodWait seconds to back off for, or None when done."""
+    global _sent_count
+    user_id, client, target_id, message_text, task_filters, forward_tag, source_peer, message_id, entity, entities = job
+
+    if not entity:
+        entity = await resolve_target_entity_once(user_id, client, target_id)
+    if not entity:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Skipping send: target %s unresolved for user %s", target_id, user_id)
+        return None
+
+    try:
+        if forward_tag and source_peer and message_id:
+            try:
+                await client.forward_messages(entity, message_id, source_peer)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Forwarded message with tag for user %s to %s", user_id, target_id)
+            except FloodWaitError:
+                raise
+            except Exception as e:
+                logger.warning("Failed to forward with tag, falling back to regular send: %s", e)
+                await client.send_message(entity, message_text, formatting_entities=entities)
+        else:
+            await client.send_message(entity, message_text, formatting_entities=entities)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Forwarded message without tag for user %s to %s", user_id, target_id)
+        _sent_count += 1
+    except FloodWaitError as fwe:
+        wait = int(getattr(fwe, "seconds", 10))
+        logger.warning("FloodWait for %s seconds for user %s target %s", wait, user_id, target_id)
+        return wait + 1
+    except Exception as e:
+        logger.exception("Error sending message for user %s to %s: %s", user_id, target_id, e)
+    return None
+
+
+async def _target_send_loop(key: Tuple[int, int], queue: asyncio.Queue):
+    """Drain one (user_id, target_id) queue in order, then exit; the router restarts it on demand."""
+    user_slots = _user_send_slots[key[0]]
+    try:
+        while not queue.empty():
+            job = queue.get_nowait()
+            _inflight_jobs[key] = job
+            try:
+                while True:
+                    until = _flood_until.get(key[0])
+                    if until is not None:
+                        delay = until - time.monotonic()
+                        if delay > 0:
+                            # Wait outside the semaphores and retry in place, keeping target order
+                            await asyncio.sleep(delay)
+                            continue
+                        _flood_until.pop(key[0], None)
+                    async with user_slots, _global_send_slots:
+                        backoff = await _send_one(job)
+                    if backoff is None:
+                        break
+                    _flood_until[key[0]] = max(_flood_until.get(key[0], 0.0), time.monotonic() + backoff)
+            except Exception:
+                logger.exception("Unexpected error sending for user %s target %s", key[0], key[1])
+            finally:
+                queue.task_done()
+            # Only reached once the job is finished; a cancelled consumer leaves it for shutdown to save
+            _inflight_jobs.pop(key, None)
+            _send_job_finished()
+    finally:
+        _target_consumers.pop(key, None)
+        if queue.empty():
+            _target_queues.pop(key, None)
+
+
+def _enqueue_send(job: Tuple):
+    """Accept a job into the send pipeline; raises asyncio.QueueFull once SEND_QUEUE_MAXSIZE jobs are unfinished."""
+    global _send_backlog
+    if _send_backlog >= SEND_QUEUE_MAXSIZE:
+        raise asyncio.QueueFull
+    send_queue.put_nowait(job)
+    _send_backlog += 1
+
+
+def _send_job_finished():
+    global _send_backlog
+    _send_backlog = max(_send_backlog - 1, 0)
+
+
+def _route_send_job(job: Tuple):
+    """Append a job to its (user_id, target_id) queue and make sure a consumer is draining it."""
+    key = (job[0], job[2])
+    queue = _target_queues.get(key)
+    if queue is None:
+        # Unbounded per target: the total across all targets is capped by _enqueue_send
+        queue = _target_queues[key] = asyncio.Queue()
+    queue.put_nowait(job)
+    if key not in _target_consumers:
+        _target_consumers[key] = asyncio.create_task(_target_send_loop(key, queue))
 
 
 async def send_worker_loop(worker_id: int):
-    """Worker that consumes send_queue and performs client.send_message with backoff."""
+    """Worker that consumes send_queue and routes each job to its per-target queue."""
     logger.info("Send worker %d started", worker_id)
-    global send_queue
-    if send_queue is None:
-        logger.error("send_worker_loop started before send_queue initialized")
-        return
 
     while True:
         try:
-            user_id, client, target_id, message_text, task_filters, forward_tag, source_chat_id, message_id = await send_queue.get()
+            job = await send_queue.get()
         except asyncio.CancelledError:
             break
         except Exception:
             logger.exception("Error getting item from send_queue in worker %d", worker_id)
             break
 
-        try:
-            entity = None
-            if user_id in target_entity_cache:
-                entity = target_entity_cache[user_id].get(target_id)
-            if not entity:
-                entity = await resolve_target_entity_once(user_id, client, target_id)
-            if not entity:
-                logger.debug("Skipping send: target %s unresolved for user %s", target_id, user_id)
-                continue
-
-            try:
-                if forward_tag and source_chat_id and message_id:
-                    try:
-                        source_entity = await client.get_input_entity(int(source_chat_id))
-                        await client.forward_messages(entity, message_id, source_entity)
-                        logger.debug("Forwarded message with tag for user %s to %s", user_id, target_id)
-                    except Exception as e:
-                        logger.warning("Failed to forward with tag, falling back to regular send: %s", e)
-                        await client.send_message(entity, message_text)
-                else:
-                    await client.send_message(entity, message_text)
-                    logger.debug("Forwarded message without tag for user %s to %s", user_id, target_id)
-                    
-            except FloodWaitError as fwe:
-                wait = int(getattr(fwe, "seconds", 10))
-                logger.warning("FloodWait for %s seconds. Pausing worker %d", wait, worker_id)
-                await asyncio.sleep(wait + 1)
-                try:
-                    await send_queue.put((user_id, client, target_id, message_text, task_filters, forward_tag, source_chat_id, message_id))
-                except asyncio.QueueFull:
-                    logger.warning("Send queue full while re-enqueueing after FloodWait; dropping message.")
-            except Exception as e:
-                logger.exception("Error sending message for user %s to %s: %s", user_id, target_id, e)
+        if job is None:
+            # Shutdown sentinel: everything queued ahead of it has been routed
+            send_queue.task_done()
+            break
 
+        try:
+            _route_send_job(job)
         except Exception:
+            _send_job_finished()
             logger.exception("Unexpected error in send worker %d", worker_id)
         finally:
             try:
@@ -1948,13 +2433,10 @@ async def send_worker_loop(worker_id: int):
 
 
 async def start_send_workers():
-    global _send_workers_started, send_queue, worker_tasks
+    global _send_workers_started, worker_tasks
     if _send_workers_started:
         return
 
-    if send_queue is None:
-        send_queue = asyncio.Queue(maxsize=SEND_QUEUE_MAXSIZE)
-
     for i in range(SEND_WORKER_COUNT):
         t = asyncio.create_task(send_worker_loop(i + 1))
         worker_tasks.append(t)
@@ -1969,7 +2451,7 @@ async def start_forwarding_for_user(user_id: int):
         return
 
     client = user_clients[user_id]
-    tasks_cache.setdefault(user_id, [])
+    tasks_cache.setdefault(user_id, {})
     target_entity_cache.setdefault(user_id, {})
 
     ensure_handler_registered_for_user(user_id, client)
@@ -1985,58 +2467,71 @@ async def restore_sessions():
         cur.execute("SELECT user_id, session_data FROM users WHERE is_logged_in = 1")
         return cur.fetchall()
 
-    try:
-        users = await asyncio.to_thread(_fetch_logged_in_users)
-    except Exception:
-        logger.exception("Error fetching logged-in users from DB")
+    users, all_active = await asyncio.gather(
+        db_call(_fetch_logged_in_users),
+        db_call(db.get_all_active_tasks),
+        return_exceptions=True,
+    )
+    if isinstance(users, BaseException):
+        logger.error("Error fetching logged-in users from DB", exc_info=users)
         users = []
-
-    try:
-        all_active = await db_call(db.get_all_active_tasks)
-    except Exception:
-        logger.exception("Error fetching active tasks from DB")
+    if isinstance(all_active, BaseException):
+        logger.error("Error fetching active tasks from DB", exc_info=all_active)
         all_active = []
 
     tasks_cache.clear()
+    source_index.clear()
+    task_counts.clear()
+    tasks_by_user: DefaultDict[int, List[Dict]] = defaultdict(list)
     for t in all_active:
-        uid = t["user_id"]
-        tasks_cache.setdefault(uid, [])
-        tasks_cache[uid].append({
-            "id": t["id"], 
-            "label": t["label"], 
-            "source_ids": t["source_ids"], 
-            "target_ids": t["target_ids"], 
-            "is_active": 1,
-            "filters": t.get("filters", {})
-        })
+        tasks_by_user[t["user_id"]].append(t)
+    for uid, user_rows in tasks_by_user.items():
+        tasks_cache[uid] = {
+            t["label"]: {
+                "id": t["id"],
+                "label": t["label"],
+                "source_ids": t["source_ids"],
+                "target_ids": t["target_ids"],
+                "is_active": 1,
+                "filters": t["filters"] or _make_default_task_filters(),
+            }
+            for t in user_rows
+        }
+        _rebuild_indices(uid)
 
     logger.info("📊 Found %d logged in user(s)", len(users))
 
-    batch_size = 5
-    for i in range(0, len(users), batch_size):
-        batch = users[i:i + batch_size]
-        restore_tasks = []
-        
-        for row in batch:
-            try:
-                user_id = row["user_id"] if isinstance(row, dict) or hasattr(row, "keys") else row[0]
-                session_data = row["session_data"] if isinstance(row, dict) or hasattr(row, "keys") else row[1]
-            except Exception:
-                try:
-                    user_id, session_data = row[0], row[1]
-                except Exception:
-                    continue
+    restore_user_ids = []
+    restore_tasks = []
+    for row in users:
+        # Database connections use sqlite3.Row, so columns are always addressable by name
+        user_id, session_data = row["user_id"], row["session_data"]
+        if session_data:
+            restore_user_ids.append(user_id)
+            restore_tasks.append(restore_single_session(user_id, session_data))
+
+    results = await _gather_bounded(restore_tasks, RESTORE_CONCURRENCY, RESTORE_TIMEOUT_SECONDS)
+    logged_out = []
+    for user_id, result in zip(restore_user_ids, results):
+        if isinstance(result, asyncio.TimeoutError):
+            # Same as a failed restore: the client was torn down, so the user has to log in again
+            logger.warning("⚠️ Restoring session for user %s timed out", user_id)
+            logged_out.append(user_id)
+        elif result is False:
+            logged_out.append(user_id)
+
+    if logged_out:
+        try:
+            await db_call(db.mark_users_logged_out, logged_out)
+        except Exception:
+            logger.exception("Error marking %d user(s) logged out after restore", len(logged_out))
 
-            if session_data:
-                restore_tasks.append(restore_single_session(user_id, session_data))
-        
-        if restore_tasks:
-            await asyncio.gather(*restore_tasks, return_exceptions=True)
-            await asyncio.sleep(1)
+    await _requeue_pending_sends()
 
 
-async def restore_single_session(user_id: int, session_data: str):
-    """Restore a single user session with error handling"""
+async def restore_single_session(user_id: int, session_data: str) -> bool:
+    """Restore a single user session; returns False when the user should be marked logged out"""
+    client = None
     try:
         # FIXED: Simplified Telethon client initialization
         client = TelegramClient(StringSession(session_data), API_ID, API_HASH)
@@ -2045,134 +2540,246 @@ async def restore_single_session(user_id: int, session_data: str):
         if await client.is_user_authorized():
             user_clients[user_id] = client
             target_entity_cache.setdefault(user_id, {})
-            user_tasks = tasks_cache.get(user_id, [])
-            all_targets = []
-            for tt in user_tasks:
-                all_targets.extend(tt.get("target_ids", []))
-            if all_targets:
+            user_tasks = tasks_cache.get(user_id, {})
+            unique_targets: Set[int] = set()
+            for tt in user_tasks.values():
+                unique_targets.update(tt["target_set"])
+            if unique_targets:
                 try:
-                    asyncio.create_task(resolve_targets_for_user(user_id, list(set(all_targets))))
+                    asyncio.create_task(resolve_targets_for_user(user_id, unique_targets))
                 except Exception:
                     logger.exception("Failed to schedule resolve_targets_for_user on restore for %s", user_id)
             await start_forwarding_for_user(user_id)
             logger.info("✅ Restored session for user %s", user_id)
-        else:
-            await db_call(db.save_user, user_id, None, None, None, False)
-            logger.warning("⚠️ Session expired for user %s", user_id)
-    except Exception as e:
-        logger.exception("❌ Failed to restore session for user %s: %s", user_id, e)
+            return True
+        logger.warning("⚠️ Session expired for user %s", user_id)
+    except (Exception, asyncio.CancelledError) as e:
+        # CancelledError: RESTORE_TIMEOUT_SECONDS ran out; don't leave a half-restored client behind
+        if not isinstance(e, asyncio.CancelledError):
+            logger.exception("❌ Failed to restore session for user %s: %s", user_id, e)
+        if client is not None and user_clients.get(user_id) is client:
+            user_clients.pop(user_id, None)
+            handler = handler_registered.pop(user_id, None)
+            if handler:
+                client.remove_event_handler(handler)
+        await _disconnect_quietly(client, user_id)
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        return False
+    await _disconnect_quietly(client, user_id)
+    return False
+
+
+async def _disconnect_quietly(client: Optional[TelegramClient], user_id: int):
+    if client is None:
+        return
+    try:
+        await client.disconnect()
+    except Exception:
+        logger.exception("Error disconnecting client after failed restore for %s", user_id)
+
+
+# ---------- Pending send persistence ----------
+def _job_to_pending_send(job: Tuple) -> Dict:
+    user_id, _client, target_id, message_text, _filters, forward_tag, source_peer, message_id, _entity, entities = job
+    if entities:
+        try:
+            message_text = markdown.unparse(message_text, entities)
+        except Exception:
+            logger.warning("Could not restore formatting of a pending send for user %s", user_id)
+    peer_row = _peer_to_row(source_peer) if source_peer is not None else None
+    return {
+        "user_id": user_id,
+        "target_id": target_id,
+        "message_text": message_text,
+        "forward_tag": forward_tag,
+        "source_peer": dict(zip(("peer_type", "peer_id", "access_hash"), peer_row)) if peer_row else None,
+        "message_id": message_id,
+    }
+
+
+def _drain_queue(queue: asyncio.Queue) -> List[Tuple]:
+    jobs = []
+    while not queue.empty():
+        job = queue.get_nowait()
+        queue.task_done()
+        if job is not None:
+            jobs.append(job)
+    return jobs
+
+
+def _collect_unsent_jobs() -> List[Dict]:
+    """Snapshot every unfinished job into storable rows, oldest first; call once consumers are stopped"""
+    global _send_backlog
+    jobs = []
+    # Per target: the job its consumer had in hand (e.g. waiting out a FloodWait), then the rest of its queue
+    for key in dict.fromkeys(list(_inflight_jobs) + list(_target_queues)):
+        if key in _inflight_jobs:
+            jobs.append(_inflight_jobs[key])
+        if key in _target_queues:
+            jobs.extend(_drain_queue(_target_queues[key]))
+    # Not yet routed, so newer than anything already in a target queue
+    jobs.extend(_drain_queue(send_queue))
+    _inflight_jobs.clear()
+    _target_queues.clear()
+    _send_backlog = 0
+    return [_job_to_pending_send(job) for job in jobs]
+
+
+async def _requeue_pending_sends(user_id: Optional[int] = None):
+    """Queue stored sends for users with a connected client; the rest stay stored for a later login or restart"""
+    try:
+        sends = await db_call(db.get_pending_sends, user_id)
+    except Exception:
+        logger.exception("Error loading pending sends")
+        return
+    requeued_ids = []
+    for send in sends:
+        client = user_clients.get(send["user_id"])
+        if client is None:
+            continue
+        source_peer = _peer_from_row(send["source_peer"]) if send["source_peer"] else None
+        message_text, entities = _parse_outgoing_text(send["message_text"])
+        job = (send["user_id"], client, send["target_id"], message_text,
+               None, send["forward_tag"], source_peer, send["message_id"],
+               target_entity_cache.get(send["user_id"], {}).get(send["target_id"]), entities)
         try:
-            await db_call(db.save_user, user_id, None, None, None, False)
+            _enqueue_send(job)
+        except asyncio.QueueFull:
+            logger.warning("Send queue full, leaving %d pending send(s) stored", len(sends) - len(requeued_ids))
+            break
+        requeued_ids.append(send["id"])
+    if requeued_ids:
+        try:
+            await db_call(db.delete_pending_sends, requeued_ids)
         except Exception:
-            logger.exception("Error marking user logged out after failed restore for %s", user_id)
+            logger.exception("Error deleting %d requeued pending send(s)", len(requeued_ids))
+    if sends:
+        logger.info("📨 Requeued %d of %d pending send(s)", len(requeued_ids), len(sends))
 
 
 # ---------- Graceful shutdown cleanup ----------
-async def shutdown_cleanup():
-    """Disconnect Telethon clients and cancel worker tasks cleanly."""
-    logger.info("Shutdown cleanup: cancelling worker tasks and disconnecting clients...")
+async def _drain_send_pipeline():
+    """Stop the send workers with one sentinel each, then let the per-target consumers finish."""
+    for _ in worker_tasks:
+        await send_queue.put(None)
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    # Workers are gone, so no new consumers can start; wait for the ones still sending
+    consumers = list(_target_consumers.values())
+    if consumers:
+        await asyncio.gather(*consumers, return_exceptions=True)
+
+
+async def shutdown_cleanup(application: Application):
+    """Drain sends, cancel worker tasks and disconnect Telethon clients on the still-running bot loop."""
+    logger.info("Shutdown cleanup: draining send queue, cancelling tasks and disconnecting clients...")
+
+    # Stop taking new messages first, so nothing is enqueued after the pending-send snapshot below
+    for uid, handler in list(handler_registered.items()):
+        client = user_clients.get(uid)
+        if client:
+            try:
+                client.remove_event_handler(handler)
+            except Exception:
+                logger.exception("Error removing event handler during shutdown for user %s", uid)
+    handler_registered.clear()
+
+    if worker_tasks:
+        try:
+            await asyncio.wait_for(_drain_send_pipeline(), SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Send queue not drained within %ds; cancelling remaining sends", SHUTDOWN_DRAIN_TIMEOUT)
+        except Exception:
+            logger.exception("Error draining send queue during shutdown")
 
     for t in list(worker_tasks):
         try:
             t.cancel()
         except Exception:
             logger.exception("Error cancelling worker task")
-    if worker_tasks:
+    consumer_tasks = list(_target_consumers.values())
+    for t in list(background_tasks) + consumer_tasks:
+        try:
+            t.cancel()
+        except Exception:
+            logger.exception("Error cancelling background task")
+    if worker_tasks or background_tasks or consumer_tasks:
         try:
-            await asyncio.gather(*worker_tasks, return_exceptions=True)
+            await asyncio.gather(*worker_tasks, *background_tasks, *consumer_tasks, return_exceptions=True)
         except Exception:
             logger.exception("Error while awaiting worker task cancellations")
 
-    user_ids = list(user_clients.keys())
-    batch_size = 5
-    for i in range(0, len(user_ids), batch_size):
-        batch = user_ids[i:i + batch_size]
-        disconnect_tasks = []
-        for uid in batch:
-            client = user_clients.get(uid)
-            if client:
-                handler = handler_registered.get(uid)
-                if handler:
-                    try:
-                        client.remove_event_handler(handler)
-                    except Exception:
-                        logger.exception("Error removing event handler during shutdown for user %s", uid)
-                    handler_registered.pop(uid, None)
+    # Whatever the drain didn't reach is kept for the next start instead of being dropped
+    try:
+        unsent = _collect_unsent_jobs()
+        if unsent:
+            await db_call(db.save_pending_sends, unsent)
+            logger.info("Saved %d pending send(s) for the next start", len(unsent))
+    except Exception:
+        logger.exception("Error saving pending sends during shutdown")
+
+    disconnect_tasks = [client.disconnect() for client in user_clients.values() if client]
+
+    if disconnect_tasks:
+        # Disconnects are pure I/O: run them all at once so shutdown takes the slowest one, capped overall
+        try:
+            await asyncio.wait_for(asyncio.gather(*disconnect_tasks, return_exceptions=True), SHUTDOWN_DISCONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out disconnecting clients after %ds", SHUTDOWN_DISCONNECT_TIMEOUT)
 
-                disconnect_tasks.append(client.disconnect())
-        
-        if disconnect_tasks:
-            await asyncio.gather(*disconnect_tasks, return_exceptions=True)
-    
     user_clients.clear()
 
+    # Let background DB writes land before the executor is shut down
+    if _write_tasks:
+        try:
+            await asyncio.wait_for(asyncio.gather(*_write_tasks, return_exceptions=True), SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("%d background DB write(s) still pending at shutdown", len(_write_tasks))
+    logger.info("Async shutdown cleanup complete.")
+
+
+def shutdown_cleanup_sync():
+    """Loop-free cleanup that runs after run_polling has closed the bot loop."""
+    _flush_pending_filter_writes_sync()
+
     try:
         db.close_connection()
     except Exception:
         logger.exception("Error closing DB connection during shutdown")
+    _db_executor.shutdown(wait=False)
 
     logger.info("Shutdown cleanup complete.")
 
 
 # ---------- Application post_init ----------
 async def post_init(application: Application):
-    global MAIN_LOOP
-    MAIN_LOOP = asyncio.get_running_loop()
-
     logger.info("🔧 Initializing bot...")
 
     await application.bot.delete_webhook(drop_pending_updates=True)
     logger.info("🧹 Cleared webhooks")
 
-    if OWNER_IDS:
-        for oid in OWNER_IDS:
-            try:
-                is_admin = await db_call(db.is_user_admin, oid)
-                if not is_admin:
-                    await db_call(db.add_allowed_user, oid, None, True, None)
-                    logger.info("✅ Added owner/admin from env: %s", oid)
-            except Exception:
-                logger.exception("Error adding owner/admin %s from env", oid)
+    if OWNER_IDS or ALLOWED_USERS:
+        try:
+            await db_call(db.bootstrap_allowed_users, list(OWNER_IDS), list(ALLOWED_USERS))
+            logger.info("✅ Ensured %d owner/admin(s) and %d allowed user(s) from env", len(OWNER_IDS), len(ALLOWED_USERS))
+        except Exception:
+            logger.exception("Error adding owners/allowed users from env")
 
-    if ALLOWED_USERS:
-        for au in ALLOWED_USERS:
-            try:
-                await db_call(db.add_allowed_user, au, None, False, None)
-                logger.info("✅ Added allowed user from env: %s", au)
-            except Exception:
-                logger.exception("Error adding allowed user %s from env: %s", au)
+    background_tasks.append(asyncio.create_task(_gc_ticker()))
+    background_tasks.append(asyncio.create_task(_entity_cache_purger()))
+    background_tasks.append(asyncio.create_task(_state_ttl_sweeper()))
+    background_tasks.append(asyncio.create_task(_memory_sampler()))
+    background_tasks.append(asyncio.create_task(_metrics_sampler()))
 
     await start_send_workers()
     await restore_sessions()
 
-    async def _collect_metrics():
-        try:
-            q = None
-            try:
-                q = send_queue.qsize() if send_queue is not None else None
-            except Exception:
-                q = None
-            return {
-                "send_queue_size": q,
-                "worker_count": len(worker_tasks),
-                "active_user_clients_count": len(user_clients),
-                "tasks_cache_counts": {uid: len(tasks_cache.get(uid, [])) for uid in list(tasks_cache.keys())},
-                "memory_usage_mb": _get_memory_usage_mb(),
-            }
-        except Exception as e:
-            return {"error": f"failed to collect metrics in loop: {e}"}
-
     def _forward_metrics():
-        global MAIN_LOOP
-        if MAIN_LOOP is not None:
-            try:
-                future = asyncio.run_coroutine_threadsafe(_collect_metrics(), MAIN_LOOP)
-                return future.result(timeout=1.0)
-            except Exception as e:
-                logger.exception("Failed to collect metrics from main loop")
-                return {"error": f"failed to collect metrics: {e}"}
-        else:
-            return {"error": "bot main loop not available"}
+        # Runs in the Flask thread: only reads the snapshot reference, never touches loop state
+        snapshot = _metrics_snapshot
+        if not snapshot:
+            return {"error": "metrics not collected yet"}
+        return dict(snapshot)
 
     try:
         register_monitoring(_forward_metrics)
@@ -2183,13 +2790,61 @@ async def post_init(application: Application):
 
 
 def _get_memory_usage_mb():
-    """Get current memory usage in MB"""
-    try:
-        import psutil
-        process = psutil.Process()
-        return round(process.memory_info().rss / 1024 / 1024, 2)
-    except ImportError:
-        return None
+    """Get the most recent memory usage sample in MB"""
+    return _memory_usage_mb
+
+
+async def _metrics_sampler():
+    """Rebuild the /metrics snapshot every METRICS_SNAPSHOT_INTERVAL seconds on the bot loop"""
+    global _metrics_snapshot
+    while True:
+        try:
+            _metrics_snapshot = {
+                "send_queue_size": send_queue.qsize(),
+                # The router inbox is usually empty; the real backlog waits in the per-target queues
+                "target_queue_backlog": sum(q.qsize() for q in _target_queues.values()),
+                "send_backlog": _send_backlog,
+                "target_queue_count": len(_target_queues),
+                "messages_sent": _sent_count,
+                "worker_count": len(worker_tasks),
+                "active_user_clients_count": len(user_clients),
+                "tasks_cache_counts": dict(task_counts),
+                "memory_usage_mb": _get_memory_usage_mb(),
+            }
+        except Exception as e:
+            _metrics_snapshot = {"error": f"failed to collect metrics in loop: {e}"}
+        await asyncio.sleep(METRICS_SNAPSHOT_INTERVAL)
+
+
+async def _memory_sampler():
+    """Refresh the RSS sample every MEMORY_SAMPLE_INTERVAL seconds for the metrics endpoint"""
+    global _memory_usage_mb
+    if psutil is None:
+        return
+    process = psutil.Process()
+    while True:
+        try:
+            _memory_usage_mb = round(process.memory_info().rss / 1024 / 1024, 2)
+        except Exception:
+            logger.exception("Error sampling memory usage")
+        await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+
+
+# ---------- Callback dispatch ----------
+# Callback action -> handler(update, context, *args) as parsed by _parse_callback_data
+_CALLBACK_HANDLERS: Dict[str, Callable] = {
+    "login": _menu_command(login_command),
+    "logout": _menu_command(logout_command),
+    "show_tasks": _menu_command(fortasks_command),
+    "chatids": handle_chatids_action,
+    "task": handle_task_menu,
+    "filter": handle_filter_menu,
+    "toggle": handle_toggle_action,
+    "delete": handle_delete_action,
+    "confirm_delete": handle_confirm_delete,
+    "prefix": functools.partial(handle_prefix_suffix, action_type="prefix"),
+    "suffix": functools.partial(handle_prefix_suffix, action_type="suffix"),
+}
 
 
 # ---------- Main -----------
@@ -2206,7 +2861,7 @@ def main():
 
     start_server_thread()
 
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    application = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(shutdown_cleanup).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("login", login_command))
@@ -2225,7 +2880,7 @@ def main():
         application.run_polling(drop_pending_updates=True)
     finally:
         try:
-            asyncio.run(shutdown_cleanup())
+            shutdown_cleanup_sync()
         except Exception:
             logger.exception("Error during shutdown cleanup")
 